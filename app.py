@@ -1,6 +1,10 @@
-from flask import Flask, request, jsonify, send_file, render_template
+from flask import Flask, request, jsonify, send_file, render_template, url_for, Response, stream_with_context, g
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.http import dump_options_header
+from werkzeug.wsgi import ClosingIterator
 import yt_dlp
+from yt_dlp.utils import download_range_func, parse_duration
 import os
 import threading
 import uuid
@@ -8,6 +12,26 @@ import re
 import requests
 import mimetypes
 import base64 # <--- ADDED THIS IMPORT for base64 decoding
+import unicodedata
+import bisect
+import io
+import copy
+import fcntl
+import glob
+import shutil
+import subprocess
+import time
+import json
+import hashlib
+import heapq
+import itertools
+import tempfile
+import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, quote
+from requests.adapters import HTTPAdapter
 
 app = Flask(__name__)
 CORS(app)
@@ -45,11 +69,2263 @@ with app.app_context():
 COOKIES_FILE_PATH = os.path.join(os.path.dirname(__file__), 'cookies.txt')
 # --- END: COOKIES SETUP FUNCTIONS ---
 
+# --- START: VIDEO INFO CACHE ---
+# Metadata lookups are cached per canonical video ID so repeat lookups skip
+# yt-dlp entirely (and don't spend the cookies' rate limit). Two caches back the
+# two-phase info API: video_summary_cache holds the quick summaries served by
+# /get_video_info, video_info_cache the format index served by /video_formats
+# (and reused by downloads). The in-memory LRUs are per worker; the optional
+# disk mirror under DOWNLOAD_DIR is shared by every gunicorn worker on the
+# instance.
+INFO_CACHE_TTL = int(os.getenv('INFO_CACHE_TTL', '1800'))  # seconds; keep below the lifetime of YouTube media URLs (~6h)
+INFO_CACHE_MAX_ENTRIES = int(os.getenv('INFO_CACHE_MAX_ENTRIES', '256'))
+INFO_CACHE_DISK = os.getenv('INFO_CACHE_DISK', '1') == '1'
+INFO_CACHE_DIR = os.path.join(DOWNLOAD_DIR, '.info_cache')
+SUMMARY_CACHE_TTL = int(os.getenv('SUMMARY_CACHE_TTL', '21600'))  # seconds; titles and channels rarely change
+SUMMARY_CACHE_DIR = os.path.join(DOWNLOAD_DIR, '.summary_cache')
+
+YOUTUBE_HOSTS = ('youtube.com', 'youtube-nocookie.com')
+YOUTUBE_ID_PATH_PREFIXES = ('shorts', 'embed', 'v', 'e', 'live')
+YOUTUBE_ID_RE = re.compile(r'^[\w-]{11}$')
+
+
+def canonical_video_key(video_url):
+    """
+    Normalizes the many URL variants of a YouTube video (youtu.be links,
+    /shorts/, /embed/, m.youtube.com, `&t=` offsets, share tracking params...)
+    to `youtube:<video id>`. Any other URL is keyed by itself, with only the
+    scheme and host lowercased and the fragment dropped: there is no video ID to
+    tell which of its parts (port, subdomain, query) are insignificant.
+    """
+    url = video_url.strip()
+    if '://' not in url:
+        url = 'https://' + url
+    parts = urlsplit(url)
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.', 'music.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+    path_segments = [segment for segment in parts.path.split('/') if segment]
+
+    video_id = None
+    if host == 'youtu.be' and path_segments:
+        video_id = path_segments[0]
+    elif host in YOUTUBE_HOSTS:
+        if path_segments[:1] == ['watch']:
+            video_id = dict(parse_qsl(parts.query, keep_blank_values=True)).get('v')
+        elif len(path_segments) >= 2 and path_segments[0] in YOUTUBE_ID_PATH_PREFIXES:
+            video_id = path_segments[1]
+
+    if video_id and YOUTUBE_ID_RE.match(video_id):
+        return f"youtube:{video_id}"
+
+    userinfo, at, host_port = parts.netloc.rpartition('@')
+    return 'url:' + urlunsplit((parts.scheme.lower(), userinfo + at + host_port.lower(), parts.path, parts.query, ''))
+
+
+def public_video_id(cache_key):
+    """
+    The ID a video is addressed by in URLs (/video_formats/<video_id>): the
+    YouTube video ID, or for other sites a hash of the canonical key.
+    """
+    if cache_key.startswith('youtube:'):
+        return cache_key[len('youtube:'):]
+    return hashlib.sha1(cache_key.encode('utf-8')).hexdigest()[:16]
+
+
+def write_json_atomic(path, data):
+    """
+    Writes `data` as JSON to a temp file next to `path` and renames it into
+    place, so readers in other workers never see a partially written file.
+    """
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"ERROR: Failed to write {path}. Details: {e}")
+
+
+class TTLCache:
+    """
+    Thread-safe LRU cache whose entries expire `ttl` seconds after being stored.
+    When `disk_dir` is given, entries are also written there as JSON so other
+    worker processes can pick them up.
+    """
+
+    def __init__(self, max_entries, ttl, disk_dir=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """Returns `(value, source)` where source is 'memory' or 'disk', or `(None, None)` on a miss."""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, value = entry
+                if now - stored_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    return value, 'memory'
+                del self._entries[key]
+
+        if self.disk_dir:
+            stored_at, value = self._read_disk(key)
+            if value is not None and now - stored_at < self.ttl:
+                self._store_in_memory(key, value, stored_at)
+                return value, 'disk'
+        return None, None
+
+    def set(self, key, value):
+        stored_at = time.time()
+        self._store_in_memory(key, value, stored_at)
+        if self.disk_dir:
+            self._write_disk(key, value, stored_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.disk_dir:
+            try: os.remove(self._disk_path(key))
+            except OSError: pass
+
+    def _store_in_memory(self, key, value, stored_at):
+        with self._lock:
+            self._entries[key] = (stored_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def _read_disk(self, key):
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return 0, None
+        if time.time() - entry.get('stored_at', 0) >= self.ttl:
+            try: os.remove(path)
+            except OSError: pass
+            return 0, None
+        return entry.get('stored_at', 0), entry.get('value')
+
+    def _write_disk(self, key, value, stored_at):
+        write_json_atomic(self._disk_path(key), {'key': key, 'stored_at': stored_at, 'value': value})
+
+
+video_info_cache = TTLCache(
+    INFO_CACHE_MAX_ENTRIES,
+    INFO_CACHE_TTL,
+    disk_dir=INFO_CACHE_DIR if INFO_CACHE_DISK else None,
+)
+# Keyed by public_video_id, so /video_formats/<video_id> can find the source URL
+video_summary_cache = TTLCache(
+    INFO_CACHE_MAX_ENTRIES,
+    SUMMARY_CACHE_TTL,
+    disk_dir=SUMMARY_CACHE_DIR if INFO_CACHE_DISK else None,
+)
+# --- END: VIDEO INFO CACHE ---
+
+# --- START: METRICS ---
+# Counters and latency histograms exported in the Prometheus text format at
+# /metrics. Recording is a dict update under a lock, so it is cheap enough for
+# every request and every yt-dlp hook call. Each gunicorn worker keeps its own
+# registry and mirrors it to DOWNLOAD_DIR/.metrics every METRICS_FLUSH_INTERVAL
+# seconds; /metrics adds up the snapshots of all live workers.
+METRICS_DIR = os.path.join(DOWNLOAD_DIR, '.metrics')
+METRICS_FLUSH_INTERVAL = int(os.getenv('METRICS_FLUSH_INTERVAL', '5'))  # seconds
+METRICS_PREFIX = 'fastvid_'
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRIC_HELP = {
+    'http_request_duration_seconds': ('histogram', 'Time to produce the response (streamed bodies are timed by the send stage).'),
+    'stage_duration_seconds': ('histogram', 'Time spent per processing stage (extract_info, download, postprocessors, send...).'),
+    'bytes_in_total': ('counter', 'Bytes fetched from upstream, by source.'),
+    'bytes_out_total': ('counter', 'Response body bytes sent to clients.'),
+    'errors_total': ('counter', 'Failed requests and jobs by error category.'),
+    'active_jobs': ('gauge', 'Download jobs in this instance by state.'),
+    'download_dir_bytes': ('gauge', 'Bytes stored under the downloads directory (cache, staging, state).'),
+    'disk_used_ratio': ('gauge', 'Fraction of the downloads volume in use.'),
+    'upstream_connections': ('gauge', 'Upstream media connections granted by the transfer scheduler.'),
+    'transfers': ('gauge', 'Upstream media transfers in this instance by state.'),
+    'format_index_reuse_total': ('counter', 'Downloads that reused the cached format index instead of extracting again.'),
+    'admission_rejections_total': ('counter', 'Requests refused by the per-client limits, by reason.'),
+    'admission_clients': ('gauge', 'Client addresses tracked by the per-client limits.'),
+    'admission_in_flight': ('gauge', 'Requests currently holding a per-client concurrency slot.'),
+}
+os.makedirs(METRICS_DIR, exist_ok=True)
+
+
+class Metrics:
+    def __init__(self):
+        self._counters = {}    # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._gauge_sources = []
+        self._lock = threading.Lock()
+
+    def add_gauges(self, source):
+        """Registers `source()`, returning `[(name, labels, value)]`, to be sampled for every snapshot."""
+        self._gauge_sources.append(source)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            values = self._histograms.get(key)
+            if values is None:
+                values = self._histograms[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+            values[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            values[-1] += seconds
+
+    @contextmanager
+    def timed(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_duration_seconds', time.perf_counter() - started, stage=stage)
+
+    def snapshot(self):
+        gauges = [[name, [list(label) for label in labels], value]
+                  for source in self._gauge_sources for name, labels, value in source()]
+        with self._lock:
+            return {
+                'counters': [[name, list(labels), value] for (name, labels), value in self._counters.items()],
+                'histograms': [[name, list(labels), list(values)] for (name, labels), values in self._histograms.items()],
+                'gauges': gauges,
+            }
+
+    def flush(self):
+        write_json_atomic(os.path.join(METRICS_DIR, f"{os.getpid()}.json"), self.snapshot())
+
+
+metrics = Metrics()
+
+
+def worker_snapshots():
+    """This worker's live snapshot plus the last flushed snapshot of every other live worker."""
+    snapshots = [metrics.snapshot()]
+    for name in os.listdir(METRICS_DIR):
+        pid_text, _, ext = name.partition('.')
+        if ext != 'json' or not pid_text.isdigit() or int(pid_text) == os.getpid():
+            continue
+        path = os.path.join(METRICS_DIR, name)
+        try:
+            os.kill(int(pid_text), 0)
+        except ProcessLookupError:
+            remove_file_quietly(path)  # That worker is gone; its counters went with it
+            continue
+        except OSError:
+            pass
+        try:
+            with open(path, 'r') as f:
+                snapshots.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+
+def render_metrics(snapshots, gauges):
+    """
+    Renders the worker snapshots, summed, plus the instance-wide `gauges`
+    ([(name, labels, value)]) in the Prometheus text format.
+    """
+    counters, histograms = {}, {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot.get('counters', []) + snapshot.get('gauges', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, values in snapshot.get('histograms', []):
+            key = (name, tuple(tuple(label) for label in labels))
+            merged = histograms.setdefault(key, [0] * len(values))
+            for i, value in enumerate(values):
+                merged[i] += value
+
+    # name -> [(label sort key, lines)]; label sets are sorted against each other,
+    # but a histogram's lines keep their order (buckets by `le`, +Inf, _sum, _count)
+    series = {}
+
+    def add_series(name, labels, lines):
+        series.setdefault(name, []).append(([(label, str(value)) for label, value in labels], lines))
+
+    for (name, labels), value in counters.items():
+        add_series(name, labels, [f"{METRICS_PREFIX}{name}{format_labels(labels)} {value}"])
+    for name, labels, value in gauges:
+        add_series(name, tuple(labels), [f"{METRICS_PREFIX}{name}{format_labels(tuple(labels))} {value}"])
+    for (name, labels), values in histograms.items():
+        lines = []
+        add_series(name, labels, lines)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), values[:-1]):
+            cumulative += count
+            lines.append(f"{METRICS_PREFIX}{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+        lines.append(f"{METRICS_PREFIX}{name}_sum{format_labels(labels)} {values[-1]}")
+        lines.append(f"{METRICS_PREFIX}{name}_count{format_labels(labels)} {cumulative}")
+
+    output = []
+    for name in sorted(series):
+        metric_type, help_text = METRIC_HELP.get(name, ('untyped', name))
+        output.append(f"# HELP {METRICS_PREFIX}{name} {help_text}")
+        output.append(f"# TYPE {METRICS_PREFIX}{name} {metric_type}")
+        for _, lines in sorted(series[name], key=lambda entry: entry[0]):
+            output.extend(lines)
+    return '\n'.join(output) + '\n'
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ByteCountingIterator:
+    """Wraps a response body, adding the bytes actually sent to bytes_out_total when it is closed."""
+
+    def __init__(self, iterable):
+        self.iterable = iterable
+        self.sent = 0
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.sent += len(chunk)
+            yield chunk
+
+    def close(self):
+        metrics.inc('bytes_out_total', self.sent)
+        if hasattr(self.iterable, 'close'):
+            self.iterable.close()
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                    route=route, method=request.method, status=str(response.status_code))
+    if response.content_length is not None:
+        metrics.inc('bytes_out_total', response.content_length)
+    elif response.is_streamed:
+        response.response = ByteCountingIterator(response.response)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    used_fraction, _ = disk_usage_fraction()
+    gauges = [
+        ('download_dir_bytes', (), directory_size(DOWNLOAD_DIR)),
+        ('disk_used_ratio', (), round(used_fraction, 4)),
+    ]
+    return Response(render_metrics(worker_snapshots(), gauges), mimetype='text/plain; version=0.0.4')
+# --- END: METRICS ---
+
+# --- START: POST-PROCESSING PLANNER ---
+# Decides, from the codecs of the formats yt-dlp selected, what it takes to
+# turn the download into the requested file: nothing, a stream-copy remux, or a
+# transcode (only for the streams the target container can't hold). Transcodes
+# run as niced ffmpeg processes, at most TRANSCODE_WORKERS at a time, so a burst
+# of mp3 conversions can't starve the workers handling requests.
+# Requested extension -> (ffmpeg muxer, video codec prefixes, audio codec prefixes) it can carry
+CONTAINER_CODECS = {
+    'mp4': ('mp4', ('avc', 'h264', 'hev', 'hvc', 'h265', 'av01', 'vp09', 'vp9'), ('mp4a', 'aac', 'mp3', 'opus')),
+    'm4a': ('mp4', (), ('mp4a', 'aac')),
+    'webm': ('webm', ('vp8', 'vp9', 'vp09', 'av01'), ('opus', 'vorbis')),
+    'mp3': ('mp3', (), ('mp3',)),
+}
+# Encoders used for streams that have to be transcoded: (video, audio)
+TRANSCODE_ENCODERS = {
+    'mp4': (['libx264', '-preset', 'veryfast', '-crf', '23'], ['aac', '-b:a', '192k']),
+    'm4a': (None, ['aac', '-b:a', '192k']),
+    'webm': (['libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8'], ['libopus', '-b:a', '160k']),
+    'mp3': (None, ['libmp3lame', '-b:a', '192k']),
+}
+NATIVE_AUDIO_EXTS = {'mp4a': 'm4a', 'opus': 'webm'}
+CPU_COUNT = os.cpu_count() or 1
+TRANSCODE_WORKERS = max(1, int(os.getenv('TRANSCODE_WORKERS', str(CPU_COUNT // 2))))
+TRANSCODE_THREADS = max(1, CPU_COUNT // TRANSCODE_WORKERS)
+transcode_slots = threading.BoundedSemaphore(TRANSCODE_WORKERS)
+
+
+def codec_fits(codec, allowed_prefixes):
+    return codec in (None, 'none') or codec.lower().startswith(allowed_prefixes)
+
+
+def plan_postprocessing(formats, file_ext, prefer_native=False):
+    """
+    Returns the post-processing plan for delivering `formats` (yt-dlp's selected
+    format dicts) as `file_ext`:
+
+      action        'none', 'remux' (stream copy) or 'transcode'
+      output_ext    extension of the delivered file
+      merge_format  container yt-dlp merges separate video/audio streams into
+      copy_video / copy_audio   which streams a transcode can still copy
+      reason        human-readable explanation, returned to the client
+
+    With `prefer_native`, audio-only requests are delivered in the source's own
+    container (m4a/opus) instead of being transcoded.
+    """
+    vcodec = next((f.get('vcodec') for f in formats if f.get('vcodec') not in (None, 'none')), None)
+    acodec = next((f.get('acodec') for f in formats if f.get('acodec') not in (None, 'none')), None)
+    plan = {'output_ext': file_ext, 'merge_format': file_ext, 'vcodec': vcodec, 'acodec': acodec,
+            'copy_video': True, 'copy_audio': True}
+
+    if file_ext not in CONTAINER_CODECS:
+        return dict(plan, action='none', reason=f"No post-processing rules for .{file_ext}; delivered as downloaded.")
+
+    _, video_codecs, audio_codecs = CONTAINER_CODECS[file_ext]
+    audio_only = not video_codecs
+    native_ext = NATIVE_AUDIO_EXTS.get((acodec or '').split('.')[0].lower())
+    if audio_only and prefer_native and native_ext:
+        plan['output_ext'] = native_ext
+        return dict(plan, action='none' if formats[-1].get('ext') == native_ext else 'remux',
+                    reason=f"Delivering the original {acodec} audio as .{native_ext} without transcoding.")
+
+    # An unknown audio codec can't be assumed to fit a single-codec container like mp3
+    plan['copy_audio'] = codec_fits(acodec, audio_codecs) and not (acodec is None and file_ext == 'mp3')
+    plan['copy_video'] = audio_only or codec_fits(vcodec, video_codecs)
+    if not plan['copy_video'] or not plan['copy_audio']:
+        incompatible = [codec for codec, ok in ((vcodec, plan['copy_video']), (acodec, plan['copy_audio'])) if not ok]
+        return dict(plan, action='transcode', merge_format='mkv',
+                    reason=f"{' and '.join(codec or 'unknown' for codec in incompatible)} can't be stored in .{file_ext}; "
+                           f"transcoding {'both streams' if len(incompatible) > 1 else 'only that stream'}.")
+
+    if audio_only:
+        plan['merge_format'] = 'mkv'
+    if len(formats) == 1 and formats[0].get('ext') == file_ext:
+        return dict(plan, action='none', reason=f"Source is already .{file_ext}.")
+    return dict(plan, action='remux', reason=f"{vcodec or ''}{'/' if vcodec and acodec else ''}{acodec or ''} fits .{file_ext}; stream copy without re-encoding.")
+
+
+def build_postprocess_command(plan, source_path, output_path):
+    muxer, video_codecs, _ = CONTAINER_CODECS.get(plan['output_ext'], (None, (), ()))
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin', '-y', '-i', source_path]
+    if muxer is None:
+        # No rules for this container: keep every stream rather than guess
+        command += ['-map', '0']
+    elif video_codecs:
+        command += ['-map', '0:v:0?', '-map', '0:a:0?']
+    else:
+        command += ['-map', '0:a:0']
+
+    if plan['action'] == 'transcode':
+        video_encoder, audio_encoder = TRANSCODE_ENCODERS[plan['output_ext']]
+        if video_codecs:
+            command += ['-c:v'] + (['copy'] if plan['copy_video'] else video_encoder)
+        command += ['-c:a'] + (['copy'] if plan['copy_audio'] else audio_encoder)
+        command += ['-threads', str(TRANSCODE_THREADS)]
+    else:
+        command += ['-c', 'copy']
+
+    if muxer == 'mp4':
+        command += ['-movflags', '+faststart']
+    if shutil.which('nice'):
+        command = ['nice', '-n', '10'] + command
+    return command + [output_path]
+
+
+def apply_postprocessing(plan, source_path, output_stem, progress_callback=None):
+    """
+    Turns the downloaded `source_path` into the planned output file and returns
+    its path. Transcodes wait for one of the TRANSCODE_WORKERS slots.
+    """
+    if plan['action'] == 'none':
+        # Delivered as downloaded, whatever extension yt-dlp ended up with
+        return source_path
+    output_path = f"{output_stem}.{plan['output_ext']}"
+    # yt-dlp reports absolute paths; output_stem may be relative to the cwd
+    same_file = os.path.abspath(source_path) == os.path.abspath(output_path)
+    if plan['action'] == 'remux' and same_file:
+        return output_path
+    if same_file:
+        output_path = f"{output_stem}.pp.{plan['output_ext']}"
+
+    stage = 'convert' if plan['action'] == 'transcode' else 'remux'
+    if progress_callback:
+        progress_callback({'stage': stage, 'downloaded_bytes': None, 'total_bytes': None, 'speed': None, 'eta': None})
+
+    command = build_postprocess_command(plan, source_path, output_path)
+    if plan['action'] == 'transcode':
+        with transcode_slots, metrics.timed(f'ffmpeg_{stage}'):
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    else:
+        with metrics.timed(f'ffmpeg_{stage}'):
+            result = subprocess.run(command, stdin=subprocess.DEVNULL, capture_output=True)
+    if result.returncode != 0:
+        remove_file_quietly(output_path)
+        raise Exception(f"Could not {stage} the download: {result.stderr.decode('utf-8', 'replace').strip()}")
+
+    remove_file_quietly(source_path)
+    final_path = f"{output_stem}.{plan['output_ext']}"
+    if output_path != final_path:
+        os.replace(output_path, final_path)
+    return final_path
+# --- END: POST-PROCESSING PLANNER ---
+
+# --- START: DOWNLOAD HELPERS ---
+BOT_DETECTION_MARKERS = (
+    "Sign in to confirm you’re not a bot",
+    "Unable to extract video data",
+    "Please use --cookies-from-browser",
+)
+BOT_DETECTION_ERROR = "YouTube detected bot activity. This might be due to missing or expired cookies. Please ensure YOUTUBE_COOKIES_BASE64 environment variable is correctly set up on Render with fresh cookies."
+
+
+def sanitize_title(video_title, default):
+    sanitized_title = re.sub(r'[^\w\s-]', '', video_title or '').strip().replace(' ', '_')
+    return sanitized_title or default
+
+
+def make_download_filename(video_title, file_ext, suffix=''):
+    unique_id = uuid.uuid4().hex[:8]
+    return f"{sanitize_title(video_title, 'download')}{suffix}_{unique_id}.{file_ext}"
+
+
+def attachment_disposition(download_name):
+    """
+    Content-Disposition value for an attachment, built like send_file does:
+    headers must be latin-1, so a non-ASCII name is sent as an ASCII fallback
+    plus its RFC 5987 `filename*` form.
+    """
+    try:
+        download_name.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+        quoted = quote(download_name, safe="!#$&+-.^_`|~")  # RFC 5987 attr-char
+        return dump_options_header('attachment', {'filename': simple, 'filename*': f"UTF-8''{quoted}"})
+    return dump_options_header('attachment', {'filename': download_name})
+
+
+def build_ydl_opts(ydl_opts, context, use_proxy=True):
+    """
+    Adds the cookies file and (optionally) the PROXY_URL proxy to a yt-dlp
+    options dict. `context` only labels the debug output.
+    """
+    if os.path.exists(COOKIES_FILE_PATH):
+        ydl_opts['cookiefile'] = COOKIES_FILE_PATH
+        print(f"DEBUG: Using cookies file for {context}: {COOKIES_FILE_PATH}")
+
+    proxy_url = os.environ.get('PROXY_URL')
+    if use_proxy and proxy_url:
+        ydl_opts['proxy'] = proxy_url
+        print(f"DEBUG: Using proxy for {context}: {proxy_url}")
+    return ydl_opts
+
+
+def remove_file_quietly(path):
+    if path and os.path.exists(path):
+        try: os.remove(path)
+        except OSError: pass
+
+
+def classify_download_error(error_message):
+    """Returns the error category (as counted in errors_total) of a yt-dlp error message."""
+    if any(marker in error_message for marker in BOT_DETECTION_MARKERS):
+        return 'bot_detection'
+    if "FFmpeg" in error_message:
+        return 'ffmpeg_missing'
+    if "age-restricted" in error_message:
+        return 'age_restricted'
+    elif "private" in error_message:
+        return 'private'
+    elif "unavailable" in error_message or "deleted" in error_message:
+        return 'unavailable'
+    elif "No such format" in error_message:
+        return 'no_such_format'
+    return 'other'
+
+
+def describe_download_error(error_message, action):
+    """
+    Maps a yt-dlp DownloadError message to a user-facing `(error, status_code)`
+    pair. `action` completes the generic "Failed to ..." message.
+    """
+    category = classify_download_error(error_message)
+    metrics.inc('errors_total', category=category)
+    if category == 'bot_detection':
+        print(f"yt-dlp download error: Bot detection suspected: {error_message}")
+        return BOT_DETECTION_ERROR, 500
+    if category == 'ffmpeg_missing':
+        return "FFmpeg is required for this download. Please ensure it's installed and in your system PATH.", 500
+    if category == 'age_restricted':
+        return "This video is age-restricted and cannot be downloaded directly.", 403
+    elif category == 'private':
+        return "This video is private and cannot be accessed.", 403
+    elif category == 'unavailable':
+        return "This video is unavailable or has been deleted.", 404
+    elif category == 'no_such_format':
+        return "The requested format is not available for this video.", 400
+    else:
+        print(f"yt-dlp download error: {error_message}")
+        return f"Failed to {action}. Details: {error_message}", 500
+
+
+# yt-dlp postprocessor keys (PostProcessor.pp_key()) mapped to the stage shown to users
+POSTPROCESSOR_STAGES = {
+    'Merger': 'merge',
+    'VideoConvertor': 'convert',
+    'ExtractAudio': 'convert',
+    'VideoRemuxer': 'remux',
+}
+
+
+def is_final_output_while_downloading(info_dict):
+    """
+    True when the file yt-dlp is writing for `info_dict` becomes the final
+    output unchanged, i.e. a plain HTTP download that none of yt-dlp's ffmpeg
+    fixups (DASH m4a, HLS, stretched pixels) will rewrite afterwards.
+    """
+    return (info_dict.get('protocol') in ('http', 'https')
+            and not (info_dict.get('ext') == 'm4a' and info_dict.get('container') == 'm4a_dash')
+            and info_dict.get('stretched_ratio') in (1, None))
+
+
+def make_progress_hooks(report, on_stream_file=None):
+    """
+    Builds yt-dlp `progress_hooks` and `postprocessor_hooks` callbacks that call
+    `report(progress)` with a compact dict: stage (download, merge, convert...),
+    bytes downloaded so far, total bytes when known, speed (bytes/s) and ETA
+    (seconds). Merged downloads fetch one file per stream, so byte counts are
+    summed over all files seen so far.
+
+    `on_stream_file(path)` is called once with the partial file being written
+    when that file will become the final output (see
+    is_final_output_while_downloading); the caller must not pass it for merged
+    or post-processed downloads.
+    """
+    streams = {}
+    announced = []
+
+    def progress_hook(d):
+        if d.get('status') not in ('downloading', 'finished'):
+            return
+        if on_stream_file and not announced and d.get('status') == 'downloading' and d.get('tmpfilename'):
+            announced.append(d['tmpfilename'])
+            if is_final_output_while_downloading(d.get('info_dict') or {}):
+                on_stream_file(d['tmpfilename'])
+        total = d.get('total_bytes') or d.get('total_bytes_estimate')
+        streams[d.get('filename')] = (d.get('downloaded_bytes') or 0, total or 0)
+        report({
+            'stage': 'download',
+            'downloaded_bytes': sum(done for done, _ in streams.values()),
+            'total_bytes': sum(size for _, size in streams.values()) or None,
+            'speed': d.get('speed'),
+            'eta': d.get('eta'),
+        })
+
+    def postprocessor_hook(d):
+        if d.get('status') != 'started':
+            return
+        report({
+            'stage': POSTPROCESSOR_STAGES.get(d.get('postprocessor'), 'postprocess'),
+            'downloaded_bytes': sum(done for done, _ in streams.values()),
+            'total_bytes': sum(size for _, size in streams.values()) or None,
+            'speed': None,
+            'eta': None,
+        })
+
+    return progress_hook, postprocessor_hook
+
+
+def download_profile(file_ext):
+    """Returns the YDLPool profile used to download as `file_ext`."""
+    return 'audio' if file_ext in ('mp3', 'm4a') else 'video'
+
+
+def select_download_format(format_id, file_ext):
+    """Returns the yt-dlp format selector used to download `format_id` as `file_ext`."""
+    if file_ext == 'mp4':
+        return f'{format_id}+bestaudio[ext=m4a]/best'
+    elif file_ext == 'mp3':
+        return format_id if 'audio' in format_id.lower() else 'bestaudio/best'
+    return format_id
+
+
+def resolve_download_info(ydl, video_url, use_index=True):
+    """
+    Returns `(info_dict, from_index)`: the video's info processed by `ydl` (so
+    its format selection is applied) but not downloaded. When /video_formats
+    has indexed the video, the extraction stored there is reused instead of
+    extracting the video again.
+    """
+    if use_index:
+        indexed = video_info_cache.get(canonical_video_key(video_url))[0]
+        if indexed and indexed.get('download_info'):
+            metrics.inc('format_index_reuse_total')
+            # Processing fills in the dict it's given, and the cached one is shared
+            return ydl.process_ie_result(copy.deepcopy(indexed['download_info']), download=False), True
+    with metrics.timed('extract_info'):
+        return ydl.extract_info(video_url, download=False), False
+
+
+def run_video_download(video_url, format_id, file_ext, video_title, progress_callback=None, stream_file_callback=None, prefer_native=False):
+    """
+    Downloads `video_url` in the requested format into DOWNLOAD_DIR and returns
+    `(filepath, download_filename, plan)`, where `plan` is the
+    plan_postprocessing decision that was applied. Partial output is removed if
+    the download fails.
+    `progress_callback`, if given, receives the dicts built by make_progress_hooks;
+    `stream_file_callback` is told about the partial file when it can be read
+    while it grows.
+    """
+    download_filename = make_download_filename(video_title, file_ext)
+    output_stem = os.path.join(DOWNLOAD_DIR, os.path.splitext(download_filename)[0])
+
+    # The partial file is only worth streaming if the plan leaves it untouched
+    stream_allowed = []
+    progress_hook = postprocessor_hook = None
+    if progress_callback or stream_file_callback:
+        on_stream_file = (lambda path: stream_file_callback(path) if stream_allowed else None) if stream_file_callback else None
+        progress_hook, postprocessor_hook = make_progress_hooks(progress_callback or (lambda progress: None), on_stream_file)
+
+    try:
+        with ydl_pool.borrow(download_profile(file_ext), progress_hook, postprocessor_hook,
+                             format=select_download_format(format_id, file_ext),
+                             outtmpl=output_stem + '.%(ext)s') as ydl:
+            use_index = True
+            while True:
+                info_dict, from_index = resolve_download_info(ydl, video_url, use_index)
+                selected_formats = info_dict.get('requested_formats') or [info_dict]
+                plan = plan_postprocessing(selected_formats, file_ext, prefer_native)
+                print(f"DEBUG: Post-processing plan for {format_id}/{file_ext}: {plan['action']} ({plan['reason']})")
+
+                ydl.params['merge_output_format'] = plan['merge_format']
+                if plan['action'] == 'none' and len(selected_formats) == 1 and not stream_allowed:
+                    stream_allowed.append(True)
+                try:
+                    with transfer_scheduler.admit(ydl, selected_formats):
+                        info_dict = ydl.process_ie_result(info_dict, download=True)
+                    break
+                except yt_dlp.DownloadError as e:
+                    if not from_index:
+                        raise
+                    # Indexed media URLs can expire or be revoked; extract once more and retry
+                    print(f"WARNING: Download from the format index failed, extracting again: {e}")
+                    video_info_cache.delete(canonical_video_key(video_url))
+                    use_index = False
+
+        downloaded_path = (info_dict.get('requested_downloads') or [{}])[0].get('filepath')
+        if not downloaded_path or not os.path.exists(downloaded_path):
+            raise Exception(f"Downloaded file not found on server at {downloaded_path}.")
+        final_filepath = apply_postprocessing(plan, downloaded_path, output_stem, progress_callback)
+    except Exception:
+        for leftover in glob.glob(glob.escape(output_stem) + '.*'):
+            remove_file_quietly(leftover)
+        raise
+
+    return final_filepath, os.path.splitext(download_filename)[0] + os.path.splitext(final_filepath)[1], plan
+
+
+def parse_segment_times(start_time, end_time):
+    """
+    Parses segment bounds given as seconds or [HH:]MM:SS strings. Returns
+    `(start, end)` in seconds, or None if either is invalid or end <= start.
+    """
+    start = parse_duration(str(start_time))
+    end = parse_duration(str(end_time))
+    if start is None or end is None or start < 0 or end <= start:
+        return None
+    return start, end
+
+
+def run_segment_download(video_url, start_time, end_time, video_title, fast_cut=False, progress_callback=None):
+    """
+    Downloads the `start_time`..`end_time` part of `video_url` as MP4 into
+    DOWNLOAD_DIR and returns `(filepath, download_filename)`.
+
+    Only the requested section is fetched: yt-dlp hands the range to ffmpeg,
+    which seeks on the input side, so a 30 second clip of a 3 hour stream
+    transfers roughly 30 seconds of media. By default the cut points are exact,
+    which means ffmpeg re-encodes the section, so the download waits for one of
+    the TRANSCODE_WORKERS slots; with `fast_cut` the streams are copied as-is
+    and the cuts snap to the nearest keyframes.
+    """
+    download_filename = make_download_filename(video_title, 'mp4', suffix='_segment')
+    filepath = os.path.join(DOWNLOAD_DIR, download_filename)
+
+    progress_hook = postprocessor_hook = None
+    if progress_callback:
+        progress_hook, postprocessor_hook = make_progress_hooks(progress_callback)
+
+    try:
+        with ydl_pool.borrow('segment', progress_hook, postprocessor_hook,
+                             outtmpl=filepath,
+                             download_ranges=download_range_func(None, [(start_time, end_time)]),
+                             force_keyframes_at_cuts=not fast_cut) as ydl:
+            # The re-encode runs inside the downloading ffmpeg, so an exact cut
+            # holds its transcode slot for the whole transfer. The slot is taken
+            # first, so a queued cut doesn't sit on a share of the bandwidth.
+            # ffmpeg fetches the range over a single connection and ignores ratelimit
+            with nullcontext() if fast_cut else transcode_slots, transfer_scheduler.admit(ydl):
+                ydl.download([video_url])
+
+        if not os.path.exists(filepath):
+            raise Exception("Downloaded segment file not found on server.")
+    except Exception:
+        remove_file_quietly(filepath)
+        raise
+
+    return filepath, download_filename
+# --- END: DOWNLOAD HELPERS ---
+
+# --- START: YOUTUBEDL POOL ---
+# Building a YoutubeDL parses cookies.txt into a cookie jar and sets up its
+# networking stack; once used it also holds warm TLS connections to the origin.
+# Instead of paying for that on every request, routes borrow a pre-built
+# instance for their option profile, apply the per-request options (format,
+# output template, progress hooks, ranges) and hand it back, which restores the
+# profile's options. Borrowing is per call rather than per thread, so it works
+# the same under threaded and gevent workers. Instances built before
+# cookies.txt last changed are retired instead of being handed out again.
+YDL_POOL_MAX_IDLE = int(os.getenv('YDL_POOL_MAX_IDLE', '4'))  # idle instances kept per profile
+YDL_POOL_WARM = os.getenv('YDL_POOL_WARM', '1') == '1'
+
+# profile -> (base yt-dlp options, whether PROXY_URL applies)
+YDL_PROFILES = {
+    # Builds the format index that downloads reuse, so it resolves media URLs
+    # the way the downloader would (same extractors, same proxy: YouTube ties
+    # its media URLs to the address that requested them)
+    'info': ({
+        'quiet': True,
+        'no_warnings': True,
+        'cachedir': False,
+        'noplaylist': True,
+        'skip_download': True,
+        'format_sort': ['res', 'ext'],
+    }, True),
+    'video': ({
+        'format': 'bestvideo+bestaudio/best',
+        'no_warnings': True,
+        'quiet': True,
+        'cachedir': False,
+        'noplaylist': True,
+    }, True),
+    'audio': ({
+        'format': 'bestaudio/best',
+        'no_warnings': True,
+        'quiet': True,
+        'cachedir': False,
+        'noplaylist': True,
+    }, True),
+    'playlist': ({
+        'quiet': True,
+        'no_warnings': True,
+        'extract_flat': 'in_playlist',
+        'skip_download': True,
+    }, False),
+    'segment': ({
+        'format': 'bestvideo+bestaudio/best',
+        'merge_output_format': 'mp4',
+        'no_warnings': True,
+        'quiet': True,
+        'cachedir': False,
+        'noplaylist': True,
+    }, True),
+}
+
+
+def cookies_file_stamp():
+    try:
+        stat = os.stat(COOKIES_FILE_PATH)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class PooledYDL:
+    """A pooled YoutubeDL plus what is needed to hand it out again clean."""
+
+    def __init__(self, profile):
+        base_opts, use_proxy = YDL_PROFILES[profile]
+        self.profile = profile
+        self.cookie_stamp = cookies_file_stamp()
+        self.hooks = {'progress': None, 'postprocessor': None}
+        self.postprocessor_started = {}
+        self.ydl = yt_dlp.YoutubeDL(build_ydl_opts(dict(base_opts), f'{profile} pool', use_proxy=use_proxy))
+        # Permanent hooks that record metrics and forward to whatever the current borrower asked for
+        self.ydl.add_progress_hook(self._on_progress)
+        self.ydl.add_postprocessor_hook(self._on_postprocessor)
+        self.base_params = dict(self.ydl.params)
+        self.base_format_selector = self.ydl.format_selector
+
+    def _on_progress(self, d):
+        transfer_scheduler.report(self.ydl, d)
+        if d.get('status') == 'finished':
+            metrics.inc('bytes_in_total', d.get('downloaded_bytes') or d.get('total_bytes') or 0, source='media')
+            if d.get('elapsed') is not None:
+                metrics.observe('stage_duration_seconds', d['elapsed'], stage='download')
+        if self.hooks['progress']:
+            self.hooks['progress'](d)
+
+    def _on_postprocessor(self, d):
+        name = d.get('postprocessor')
+        if d.get('status') == 'started':
+            self.postprocessor_started[name] = time.perf_counter()
+        elif d.get('status') == 'finished' and name in self.postprocessor_started:
+            metrics.observe('stage_duration_seconds', time.perf_counter() - self.postprocessor_started.pop(name),
+                            stage=f'postprocessor:{name}')
+        if self.hooks['postprocessor']:
+            self.hooks['postprocessor'](d)
+
+    def configure(self, progress_hook=None, postprocessor_hook=None, **overrides):
+        params = self.ydl.params
+        for name, value in overrides.items():
+            if name == 'outtmpl':
+                value = dict(params['outtmpl'], default=value)
+            params[name] = value
+        if 'format' in overrides:
+            self.ydl.format_selector = self.ydl.build_format_selector(overrides['format'])
+        self.hooks['progress'] = progress_hook
+        self.hooks['postprocessor'] = postprocessor_hook
+
+    def reset(self):
+        self.ydl.params.clear()
+        self.ydl.params.update(self.base_params)
+        self.ydl.format_selector = self.base_format_selector
+        self.hooks['progress'] = self.hooks['postprocessor'] = None
+
+    def close(self):
+        # yt-dlp writes its cookie jar back on close; a retired instance must
+        # not overwrite the (possibly newer) file the pool is watching
+        self.ydl.params['cookiefile'] = None
+        try:
+            self.ydl.close()
+        except Exception as e:
+            print(f"Error closing pooled YoutubeDL ({self.profile}): {e}")
+
+
+class YDLPool:
+    def __init__(self, max_idle):
+        self.max_idle = max_idle
+        self._idle = {profile: [] for profile in YDL_PROFILES}
+        self._lock = threading.Lock()
+
+    def _checkout(self, profile):
+        stamp = cookies_file_stamp()
+        stale = []
+        entry = None
+        with self._lock:
+            idle = self._idle[profile]
+            while idle:
+                candidate = idle.pop()
+                if candidate.cookie_stamp == stamp:
+                    entry = candidate
+                    break
+                stale.append(candidate)
+        for candidate in stale:
+            candidate.close()
+        return entry or PooledYDL(profile)
+
+    def _checkin(self, entry):
+        entry.reset()
+        with self._lock:
+            idle = self._idle[entry.profile]
+            if entry.cookie_stamp == cookies_file_stamp() and len(idle) < self.max_idle:
+                idle.append(entry)
+                return
+        entry.close()
+
+    @contextmanager
+    def borrow(self, profile, progress_hook=None, postprocessor_hook=None, **overrides):
+        """
+        Lends a YoutubeDL built for `profile` with `overrides` applied to its
+        options (`format` and `outtmpl` are handled the way the constructor
+        would) and the given hooks installed. Options the caller changes on
+        `ydl.params` while borrowing are undone when it is returned.
+        """
+        entry = self._checkout(profile)
+        try:
+            entry.configure(progress_hook, postprocessor_hook, **overrides)
+            yield entry.ydl
+        finally:
+            self._checkin(entry)
+
+    def warm(self):
+        """Builds one idle instance per profile so first requests don't pay for it."""
+        for profile in YDL_PROFILES:
+            self._checkin(self._checkout(profile))
+
+
+ydl_pool = YDLPool(YDL_POOL_MAX_IDLE)
+
+# Thumbnail fetches share one keep-alive connection pool instead of opening a
+# new TLS connection per request
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '16'))
+HTTP_TIMEOUT = (10, 30)  # connect, read (seconds)
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE))
+
+if YDL_POOL_WARM:
+    ydl_pool.warm()
+# --- END: YOUTUBEDL POOL ---
+
+# --- START: TRANSFER SCHEDULER ---
+# Every upstream media transfer (yt-dlp downloads and ffmpeg streams) first
+# takes connections from a process-wide budget of MAX_UPSTREAM_CONNECTIONS.
+# Fragmented formats (HLS/DASH) get up to FRAGMENT_CONCURRENCY of them, so
+# their fragments download in parallel; plain HTTP downloads need one. When
+# the budget is spent, new transfers wait, and with TRANSFER_POLICY=priority
+# the smallest expected download is admitted first.
+# With UPSTREAM_BANDWIDTH set, the scheduler also splits that many bytes/s
+# across active transfers, either in equal shares ('fair') or weighted
+# towards the transfers with the fewest bytes left ('priority'), so small and
+# nearly finished downloads complete first. yt-dlp reads its `ratelimit`
+# option while downloading, so shares are re-applied as transfers progress.
+UPSTREAM_BANDWIDTH = int(os.getenv('UPSTREAM_BANDWIDTH', '0'))  # bytes/s shared by all transfers; 0 = unlimited
+MAX_UPSTREAM_CONNECTIONS = int(os.getenv('MAX_UPSTREAM_CONNECTIONS', '16'))
+FRAGMENT_CONCURRENCY = int(os.getenv('FRAGMENT_CONCURRENCY', '4'))  # connections per fragmented download
+TRANSFER_POLICY = os.getenv('TRANSFER_POLICY', 'priority')  # 'priority' or 'fair'
+MIN_TRANSFER_RATE = 64 * 1024  # bytes/s; no transfer is throttled below this
+TRANSFER_REBALANCE_INTERVAL = 1.0  # seconds between share updates driven by progress
+FRAGMENTED_PROTOCOLS = ('m3u8_native', 'http_dash_segments', 'http_dash_segments_generator', 'ism', 'f4m')
+
+
+class Transfer:
+    def __init__(self, ydl, connections_wanted, expected_bytes):
+        self.ydl = ydl
+        self.connections_wanted = connections_wanted
+        self.connections = 0
+        self.expected_bytes = expected_bytes
+        self.rate = None
+        self.files = {}  # filename -> (downloaded bytes, total bytes)
+
+    def remaining_bytes(self):
+        """Bytes still to download, or None when the size isn't known."""
+        total = sum(size for _, size in self.files.values()) or self.expected_bytes
+        if not total:
+            return None
+        return max(0, total - sum(done for done, _ in self.files.values()))
+
+
+class TransferScheduler:
+    def __init__(self, bandwidth, max_connections, fragment_concurrency, policy):
+        self.bandwidth = bandwidth
+        self.max_connections = max_connections
+        self.fragment_concurrency = fragment_concurrency
+        self.policy = policy
+        self._active = []
+        self._waiting = []
+        self._by_ydl = {}
+        self._rebalanced_at = 0
+        self._changed = threading.Condition()
+
+    @contextmanager
+    def admit(self, ydl=None, formats=(), connections=None):
+        """Holds upstream connections (and a bandwidth share) for a transfer run by `ydl`."""
+        transfer = self.acquire(ydl, formats, connections)
+        try:
+            yield transfer
+        finally:
+            self.release(transfer)
+
+    def acquire(self, ydl=None, formats=(), connections=None):
+        """
+        Waits for upstream connections for a transfer of `formats` (yt-dlp
+        format dicts) and returns its Transfer. `connections` overrides how many
+        it asks for. When `ydl` runs the transfer, its fragment concurrency and
+        rate limit are set from the grant.
+        """
+        if connections is None:
+            fragmented = any(f.get('protocol') in FRAGMENTED_PROTOCOLS for f in formats)
+            connections = self.fragment_concurrency if fragmented else 1
+        expected_bytes = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats) or None
+        transfer = Transfer(ydl, min(connections, self.max_connections), expected_bytes)
+
+        with self._changed:
+            self._waiting.append(transfer)
+            while self._next_waiting() is not transfer or self._free_connections() < 1:
+                self._changed.wait()
+            self._waiting.remove(transfer)
+            # Leave room for the transfers queued behind this one
+            fair_share = max(1, self.max_connections // (len(self._active) + len(self._waiting) + 1))
+            transfer.connections = min(transfer.connections_wanted, self._free_connections(), fair_share)
+            self._active.append(transfer)
+            if ydl is not None:
+                self._by_ydl[id(ydl)] = transfer
+                # Fixed for the transfer's lifetime: yt-dlp sizes its fragment pool when it starts
+                ydl.params['concurrent_fragment_downloads'] = transfer.connections
+            self._rebalance_locked()
+            self._changed.notify_all()
+        return transfer
+
+    def release(self, transfer):
+        with self._changed:
+            self._active.remove(transfer)
+            if transfer.ydl is not None:
+                self._by_ydl.pop(id(transfer.ydl), None)
+            self._rebalance_locked()
+            self._changed.notify_all()
+
+    def report(self, ydl, progress):
+        """Feeds a yt-dlp progress dict of a scheduled `ydl` into the priority calculation."""
+        transfer = self._by_ydl.get(id(ydl))
+        if transfer is None or progress.get('status') not in ('downloading', 'finished'):
+            return
+        transfer.files[progress.get('filename')] = (
+            progress.get('downloaded_bytes') or 0,
+            progress.get('total_bytes') or progress.get('total_bytes_estimate') or 0,
+        )
+        if self.bandwidth and self.policy == 'priority' and time.time() - self._rebalanced_at >= TRANSFER_REBALANCE_INTERVAL:
+            with self._changed:
+                self._rebalance_locked()
+
+    def stats(self):
+        with self._changed:
+            return [
+                ('upstream_connections', (), sum(t.connections for t in self._active)),
+                ('transfers', (('state', 'active'),), len(self._active)),
+                ('transfers', (('state', 'waiting'),), len(self._waiting)),
+            ]
+
+    def _free_connections(self):
+        return self.max_connections - sum(t.connections for t in self._active)
+
+    def _next_waiting(self):
+        if self.policy != 'priority':
+            return self._waiting[0]
+        # Smallest known download first; unknown sizes after, in arrival order
+        return min(self._waiting, key=lambda t: (t.expected_bytes is None, t.expected_bytes or 0))
+
+    def _rebalance_locked(self):
+        self._rebalanced_at = time.time()
+        if not self._active:
+            return
+        if not self.bandwidth:
+            shares = [None] * len(self._active)
+        elif self.policy == 'priority':
+            # Weight 1, 1/2, 1/3... by bytes left, so the closest to done gets the largest share
+            ranked = sorted(self._active, key=lambda t: (t.remaining_bytes() is None, t.remaining_bytes() or 0))
+            weights = {id(t): 1 / (rank + 1) for rank, t in enumerate(ranked)}
+            total_weight = sum(weights.values())
+            shares = [self.bandwidth * weights[id(t)] / total_weight for t in self._active]
+        else:
+            shares = [self.bandwidth / len(self._active)] * len(self._active)
+
+        for transfer, share in zip(self._active, shares):
+            transfer.rate = share
+            if transfer.ydl is not None:
+                # yt-dlp applies ratelimit per connection
+                transfer.ydl.params['ratelimit'] = max(MIN_TRANSFER_RATE, share / transfer.connections) if share else None
+
+
+transfer_scheduler = TransferScheduler(UPSTREAM_BANDWIDTH, MAX_UPSTREAM_CONNECTIONS, FRAGMENT_CONCURRENCY, TRANSFER_POLICY)
+metrics.add_gauges(transfer_scheduler.stats)
+# --- END: TRANSFER SCHEDULER ---
+
+# --- START: REQUEST COALESCING ---
+# Identical info lookups and downloads that arrive while one is already running
+# wait for that run instead of starting their own yt-dlp process. Within a
+# worker this is coordinated with threads; SINGLE_FLIGHT_MODE=file additionally
+# takes an flock per key under DOWNLOAD_DIR/.locks so leaders in other gunicorn
+# workers wait too, then pick the result up from the shared caches.
+SINGLE_FLIGHT_MODE = os.getenv('SINGLE_FLIGHT_MODE', 'thread')  # 'thread' or 'file'
+SINGLE_FLIGHT_LOCK_DIR = os.path.join(DOWNLOAD_DIR, '.locks')
+SINGLE_FLIGHT_POLL_INTERVAL = 0.25  # seconds
+GROWING_FILE_CHUNK_SIZE = 64 * 1024
+
+
+class Flight:
+    """A call in progress: the leader fills in `result` or `error`, then sets `done`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.stream_path = None
+        self.listeners = []
+
+
+class GrowingFile:
+    """
+    Iterates over a file another thread is still downloading, waiting for more
+    data at EOF until the leader's flight is done. If the leader fails, the
+    error is re-raised, which aborts the response mid-transfer.
+    """
+
+    def __init__(self, flight, file_obj):
+        self.flight = flight
+        self.file_obj = file_obj
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.file_obj.read(GROWING_FILE_CHUNK_SIZE)
+                if chunk:
+                    yield chunk
+                elif self.flight.done.is_set():
+                    # The leader is finished, so whatever is left is already on disk
+                    while chunk := self.file_obj.read(GROWING_FILE_CHUNK_SIZE):
+                        yield chunk
+                    if self.flight.error is not None:
+                        raise self.flight.error
+                    return
+                else:
+                    self.flight.done.wait(SINGLE_FLIGHT_POLL_INTERVAL)
+        finally:
+            self.file_obj.close()
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. `do()` returns `(result, shared)`:
+    the leader runs `fn`, concurrent callers with the same key block and receive
+    the leader's result (or exception) with `shared=True`.
+    """
+
+    def __init__(self, mode, lock_dir):
+        self.mode = mode
+        self.lock_dir = lock_dir
+        self._flights = {}
+        self._lock = threading.Lock()
+        if mode == 'file':
+            os.makedirs(lock_dir, exist_ok=True)
+
+    def do(self, key, fn, check=None, on_progress=None, accept_stream=False):
+        """
+        `check` is consulted by the leader (in file mode, after acquiring the
+        lock) and returns an existing result (e.g. from a shared cache) or None.
+        `on_progress` lets followers receive the leader's progress reports. With
+        `accept_stream`, a follower may instead get a GrowingFile as soon as the
+        leader publishes a file that can be read while it downloads.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+            elif on_progress:
+                flight.listeners.append(on_progress)
+
+        if not leader:
+            return self._follow(flight, accept_stream), True
+
+        try:
+            flight.result = self._lead(key, fn, check)
+            return flight.result, False
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def report(self, key, progress):
+        """Forwards a leader's progress report to the followers of `key`."""
+        with self._lock:
+            flight = self._flights.get(key)
+            listeners = list(flight.listeners) if flight else []
+        for listener in listeners:
+            listener(progress)
+
+    def publish_stream(self, key, path):
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                flight.stream_path = path
+
+    def _follow(self, flight, accept_stream):
+        while not flight.done.wait(SINGLE_FLIGHT_POLL_INTERVAL if accept_stream else None):
+            if flight.stream_path:
+                try:
+                    return GrowingFile(flight, open(flight.stream_path, 'rb'))
+                except OSError:
+                    pass  # Renamed or not created yet; keep waiting for the result
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _lead(self, key, fn, check):
+        if self.mode != 'file':
+            # A previous leader may have finished between the caller's cache lookup and now
+            existing = check() if check else None
+            return existing if existing is not None else fn()
+
+        lock_path = os.path.join(self.lock_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.lock')
+        with open(lock_path, 'a') as lock_file:
+            # Poll instead of blocking in flock() so a gevent worker's other greenlets keep running
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+            try:
+                existing = check() if check else None
+                return existing if existing is not None else fn()
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+info_flights = SingleFlight(SINGLE_FLIGHT_MODE, SINGLE_FLIGHT_LOCK_DIR)
+download_flights = SingleFlight(SINGLE_FLIGHT_MODE, SINGLE_FLIGHT_LOCK_DIR)
+# --- END: REQUEST COALESCING ---
+
+# --- START: DOWNLOAD CACHE ---
+# Finished downloads are kept under DOWNLOAD_DIR/cache, named after a hash of
+# (video, format, extension, segment range), so the next request for the same
+# artifact is served straight from disk. Files are evicted least-recently-used
+# first once the cache grows past DOWNLOAD_CACHE_MAX_BYTES; files that are being
+# served (or were touched within DOWNLOAD_CACHE_GRACE seconds, which covers
+# transfers running in other workers) are never evicted.
+DOWNLOAD_CACHE_DIR = os.path.join(DOWNLOAD_DIR, 'cache')
+DOWNLOAD_CACHE_MAX_BYTES = int(os.getenv('DOWNLOAD_CACHE_MAX_BYTES', str(600 * 1024 * 1024)))
+DOWNLOAD_CACHE_GRACE = int(os.getenv('DOWNLOAD_CACHE_GRACE', '120'))  # seconds
+
+
+class DownloadCache:
+    """
+    Content-addressed store of finished downloads with an LRU size quota.
+    `lookup` and `store` return the cached path with a reference held; callers
+    must `release` it once they are done serving the file.
+    """
+
+    def __init__(self, cache_dir, max_bytes, grace):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.grace = grace
+        self._refs = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key, ext):
+        return os.path.join(self.cache_dir, f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}.{ext}")
+
+    def lookup(self, key, ext=None):
+        """Returns the acquired path cached under `key`; with `ext=None` any extension matches."""
+        with self._lock:
+            if ext:
+                path = self.path_for(key, ext)
+                if not os.path.exists(path):
+                    return None
+            else:
+                matches = glob.glob(glob.escape(self.path_for(key, '')) + '*')
+                if not matches:
+                    return None
+                path = matches[0]
+            self._acquire_locked(path)
+        return path
+
+    def store(self, key, staged_path):
+        """Moves a freshly downloaded file into the cache and returns its (acquired) cache path."""
+        ext = os.path.splitext(staged_path)[1].lstrip('.')
+        path = self.path_for(key, ext)
+        with self._lock:
+            os.replace(staged_path, path)
+            self._acquire_locked(path)
+        self.evict()
+        return path
+
+    def acquire(self, path):
+        with self._lock:
+            if not os.path.exists(path):
+                return False
+            self._acquire_locked(path)
+        return True
+
+    def release(self, path):
+        with self._lock:
+            refs = self._refs.get(path, 0) - 1
+            if refs > 0:
+                self._refs[path] = refs
+            else:
+                self._refs.pop(path, None)
+
+    def _acquire_locked(self, path):
+        self._refs[path] = self._refs.get(path, 0) + 1
+        try:
+            os.utime(path)  # mtime doubles as the LRU "last used" time
+        except OSError:
+            pass
+
+    def evict(self, free_bytes=0):
+        """
+        Deletes least-recently-used files until the cache fits in `max_bytes`
+        and at least `free_bytes` have been freed.
+        """
+        now = time.time()
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+            total_bytes = sum(size for _, size, _ in entries)
+            target_bytes = min(self.max_bytes, total_bytes - free_bytes)
+            for mtime, size, path in sorted(entries):
+                if total_bytes <= target_bytes:
+                    break
+                if self._refs.get(path) or now - mtime < self.grace:
+                    continue
+                try:
+                    os.remove(path)
+                    total_bytes -= size
+                    print(f"Evicted from download cache: {path}")
+                except OSError as e:
+                    print(f"Error evicting cached file {path}: {e}")
+
+
+download_cache = DownloadCache(DOWNLOAD_CACHE_DIR, DOWNLOAD_CACHE_MAX_BYTES, DOWNLOAD_CACHE_GRACE)
+
+
+def download_cache_key(video_url, *parts):
+    return '|'.join([canonical_video_key(video_url)] + [str(part) for part in parts])
+
+
+def video_cache_key(video_url, format_id, file_ext, prefer_native=False):
+    return download_cache_key(video_url, format_id, file_ext, 'native' if prefer_native else 'exact')
+
+
+def fetch_cached_download(key, file_ext, download, progress_callback=None, accept_stream=False, disk_wait=0):
+    """
+    Returns `(path, cache_status)` for the artifact cached under `key`, running
+    `download(report_progress, publish_stream)` to produce it on a miss.
+    Concurrent misses for the same key share one download (see SingleFlight);
+    `cache_status` is 'HIT', 'MISS' for the request that ran the download, or
+    'COALESCED' for the ones that waited on it.
+    The returned path is held in `download_cache` and must be released by the
+    caller. With `accept_stream`, a follower may get a GrowingFile instead.
+    A miss waits up to `disk_wait` seconds for disk space (see
+    wait_for_disk_space) before downloading.
+    """
+    cached_path = download_cache.lookup(key, file_ext)
+    if cached_path:
+        return cached_path, 'HIT'
+
+    def report_progress(progress):
+        if progress_callback:
+            progress_callback(progress)
+        download_flights.report(key, progress)
+
+    def run_download():
+        wait_for_disk_space(disk_wait, on_wait=lambda: report_progress(
+            {'stage': 'disk_wait', 'downloaded_bytes': None, 'total_bytes': None, 'speed': None, 'eta': None}))
+        filepath = download(report_progress, lambda path: download_flights.publish_stream(key, path))
+        return download_cache.store(key, filepath)
+
+    path, shared = download_flights.do(
+        key,
+        run_download,
+        check=lambda: download_cache.lookup(key, file_ext),
+        on_progress=progress_callback,
+        accept_stream=accept_stream,
+    )
+    if shared and not isinstance(path, GrowingFile) and not download_cache.acquire(path):
+        raise Exception("The shared download was evicted before it could be served.")
+    return path, 'COALESCED' if shared else 'MISS'
+
+
+def fetch_video_download(video_url, format_id, file_ext, video_title, progress_callback=None, accept_stream=False, prefer_native=False, disk_wait=0):
+    """
+    Returns `(path, download_filename, cache_status, plan)` for a full video/audio
+    download, reusing a cached artifact when one exists. `plan` is the
+    post-processing decision, or None when this call didn't run the download.
+    """
+    plans = []
+
+    def download(report_progress, publish_stream):
+        filepath, _, plan = run_video_download(video_url, format_id, file_ext, video_title,
+                                               report_progress, publish_stream, prefer_native)
+        plans.append(plan)
+        return filepath
+
+    key = video_cache_key(video_url, format_id, file_ext, prefer_native)
+    # With prefer_native the cached file's extension depends on the source, so look it up by the key
+    # alone; for the same reason a follower can't name a growing file before it's finished
+    path, cache_status = fetch_cached_download(key, None if prefer_native else file_ext, download, progress_callback,
+                                               accept_stream and not prefer_native, disk_wait)
+    delivered_ext = file_ext if isinstance(path, GrowingFile) else os.path.splitext(path)[1].lstrip('.')
+    return path, make_download_filename(video_title, delivered_ext), cache_status, (plans[0] if plans else None)
+
+
+def fetch_segment_download(video_url, start_time, end_time, video_title, fast_cut=False, progress_callback=None, disk_wait=0):
+    """Same as fetch_video_download, for a `start_time`..`end_time` segment."""
+    def download(report_progress, publish_stream):
+        filepath, _ = run_segment_download(video_url, start_time, end_time, video_title,
+                                           fast_cut=fast_cut, progress_callback=report_progress)
+        return filepath
+
+    key = download_cache_key(video_url, 'segment', start_time, end_time, 'fast' if fast_cut else 'exact', 'mp4')
+    path, cache_status = fetch_cached_download(key, 'mp4', download, progress_callback, disk_wait=disk_wait)
+    return path, make_download_filename(video_title, 'mp4', suffix='_segment'), cache_status
+
+
+class CachedFileHandle(io.FileIO):
+    """
+    A cached download opened for sending. Closing it (the WSGI server does,
+    once the body is sent or aborted) runs the `call_on_close` callbacks once.
+    Unlike wrapping the response body, this leaves the server's file wrapper,
+    and with it sendfile(), in place.
+    """
+
+    def __init__(self, path):
+        self._on_close = []
+        super().__init__(path, 'rb')
+
+    def call_on_close(self, func):
+        if self.closed:
+            func()
+        else:
+            self._on_close.append(func)
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            super().close()
+        finally:
+            callbacks, self._on_close = self._on_close, []
+            for func in callbacks:
+                func()
+
+
+def send_cached_file(path, download_name, cache_status=None):
+    """
+    Sends a file held in `download_cache` as an attachment and releases the
+    reference once the response has been fully sent (or aborted).
+    """
+    started = time.perf_counter()
+    try:
+        handle = CachedFileHandle(path)
+    except OSError:
+        download_cache.release(path)
+        raise
+    handle.call_on_close(lambda: download_cache.release(path))
+    handle.call_on_close(lambda: metrics.observe('stage_duration_seconds', time.perf_counter() - started, stage='send'))
+    try:
+        stat = os.fstat(handle.fileno())
+        # send_file can't stat a file object, so the size, validators and
+        # range handling it would derive from a path are filled in here. Cached
+        # files are only ever replaced, never rewritten, and their mtime tracks
+        # LRU use, so the inode identifies the content.
+        response = send_file(handle, as_attachment=True, download_name=download_name, conditional=False,
+                             etag=f"{stat.st_ino}-{stat.st_size}", last_modified=stat.st_mtime)
+        response.content_length = stat.st_size
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    except Exception:
+        handle.close()
+        raise
+    if cache_status:
+        response.headers['X-Cache'] = cache_status
+    g.sent_file = handle  # lets after_request hooks hang their cleanup off the same close
+    return response
+# --- END: DOWNLOAD CACHE ---
+
+# --- START: JANITOR ---
+# Housekeeping runs on one background thread that sleeps until the earliest
+# entry in a heap of due times, instead of a thread per file. Downloads are
+# never deleted on a timer: they live in download_cache, which only evicts
+# files no response is holding. The janitor removes what crashed or killed
+# workers leave behind (staged downloads, stale job and info-cache files) and
+# guards the volume: above DISK_HIGH_WATERMARK new downloads first evict cached
+# files down to DISK_LOW_WATERMARK, and if that isn't enough they are refused
+# (or, for jobs, kept waiting until space frees up).
+JANITOR_SWEEP_INTERVAL = int(os.getenv('JANITOR_SWEEP_INTERVAL', '300'))  # seconds
+ORPHAN_MAX_AGE = int(os.getenv('ORPHAN_MAX_AGE', '3600'))  # seconds a staged file can go untouched before it's an orphan
+DISK_HIGH_WATERMARK = float(os.getenv('DISK_HIGH_WATERMARK', '0.90'))  # fraction of the volume in use
+DISK_LOW_WATERMARK = float(os.getenv('DISK_LOW_WATERMARK', '0.75'))
+DISK_RETRY_AFTER = 60  # seconds, sent with 503 responses
+DISK_CHECK_INTERVAL = 5  # seconds between checks while a job waits for space
+
+
+class InsufficientDiskSpace(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        metrics.inc('errors_total', category='disk_space')
+
+
+class Janitor:
+    """Runs housekeeping callables at their due time on a single daemon thread."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()  # tie-breaker, so callables are never compared
+        self._changed = threading.Condition()
+        self._pid = None
+
+    def start(self):
+        """Starts the janitor thread in this process, unless it's already running."""
+        if self._pid == os.getpid():
+            return
+        with self._changed:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._run, name='janitor', daemon=True).start()
+
+    def schedule(self, delay, fn, *args):
+        with self._changed:
+            heapq.heappush(self._heap, (time.time() + delay, next(self._counter), fn, args))
+            self._changed.notify()
+
+    def every(self, interval, fn, delay=0):
+        """Runs `fn` after `delay` seconds and then every `interval` seconds."""
+        def run_and_reschedule():
+            try:
+                fn()
+            finally:
+                self.schedule(interval, run_and_reschedule)
+        self.schedule(delay, run_and_reschedule)
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._changed.wait(self._heap[0][0] - time.time() if self._heap else None)
+                _, _, fn, args = heapq.heappop(self._heap)
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"ERROR: Janitor task {getattr(fn, '__name__', fn)} failed: {e}")
+
+
+janitor = Janitor()
+
+
+@app.before_request
+def start_janitor():
+    # Started by the first request of each process rather than at import: with
+    # preload_app the gunicorn master imports the app and forks the workers,
+    # and it must not be running threads (or hold their locks) when it forks
+    janitor.start()
+
+
+def disk_usage_fraction():
+    usage = shutil.disk_usage(DOWNLOAD_DIR)
+    return usage.used / usage.total, usage
+
+
+def make_disk_space():
+    """
+    Returns True if a new download may start. Above the high watermark, cached
+    downloads are evicted first to bring the volume back to the low watermark.
+    """
+    used_fraction, usage = disk_usage_fraction()
+    if used_fraction < DISK_HIGH_WATERMARK:
+        return True
+    download_cache.evict(free_bytes=usage.used - DISK_LOW_WATERMARK * usage.total)
+    return disk_usage_fraction()[0] < DISK_HIGH_WATERMARK
+
+
+def wait_for_disk_space(timeout=0, on_wait=None):
+    """Waits up to `timeout` seconds for make_disk_space(); raises InsufficientDiskSpace otherwise."""
+    deadline = time.time() + timeout
+    while not make_disk_space():
+        if time.time() >= deadline:
+            raise InsufficientDiskSpace("The server is low on disk space. Please try again in a few minutes.")
+        if on_wait:
+            on_wait()
+        time.sleep(DISK_CHECK_INTERVAL)
+
+
+def remove_stale_files(directory, max_age, suffixes=None):
+    """Removes regular files in `directory` (not subdirectories) last modified more than `max_age` seconds ago."""
+    cutoff = time.time() - max_age
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return
+    for name in names:
+        path = os.path.join(directory, name)
+        if suffixes and not name.endswith(suffixes):
+            continue
+        try:
+            if os.path.isfile(path) and os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                print(f"Janitor removed stale file: {path}")
+        except OSError:
+            pass
+
+
+def sweep_orphans():
+    # Partial downloads and post-processing leftovers; live ones are written to continuously
+    remove_stale_files(DOWNLOAD_DIR, ORPHAN_MAX_AGE)
+    remove_stale_files(INFO_CACHE_DIR, INFO_CACHE_TTL, suffixes=('.json',))
+    remove_stale_files(INFO_CACHE_DIR, ORPHAN_MAX_AGE, suffixes=('.tmp',))
+    remove_stale_files(SUMMARY_CACHE_DIR, SUMMARY_CACHE_TTL, suffixes=('.json',))
+    remove_stale_files(SUMMARY_CACHE_DIR, ORPHAN_MAX_AGE, suffixes=('.tmp',))
+    make_disk_space()
+
+
+janitor.every(JANITOR_SWEEP_INTERVAL, sweep_orphans)  # first sweep runs once the process serves requests
+janitor.every(METRICS_FLUSH_INTERVAL, metrics.flush)
+# --- END: JANITOR ---
+
+# --- START: CLIENT ADMISSION ---
+# Per-client-IP limits on the routes that cost upstream fetches, disk or CPU, so
+# one heavy user can't starve the others. Every client gets a token bucket of
+# CLIENT_RATE_LIMIT requests per minute (bursting up to CLIENT_RATE_BURST) and
+# at most CLIENT_MAX_CONCURRENT of those requests in flight; a streamed response
+# holds its slot until the body is closed. Batch requests are charged a token
+# per item once their items are known: a batch may overdraw the bucket, which
+# then refuses the client's requests (and further batches) until it refills.
+# Limits are per worker process.
+# Behind a reverse proxy, set TRUSTED_PROXY_HOPS so the client address is taken
+# from X-Forwarded-For instead of being the proxy's.
+CLIENT_RATE_LIMIT = int(os.getenv('CLIENT_RATE_LIMIT', '60'))  # requests per minute; 0 = unlimited
+CLIENT_RATE_BURST = int(os.getenv('CLIENT_RATE_BURST', '20'))
+CLIENT_MAX_CONCURRENT = int(os.getenv('CLIENT_MAX_CONCURRENT', '4'))  # 0 = unlimited
+CLIENT_CONCURRENCY_RETRY_AFTER = 5  # seconds, sent with 429 responses for too many requests in flight
+CLIENT_IDLE_TTL = 600  # seconds before an idle client's state is forgotten
+TRUSTED_PROXY_HOPS = int(os.getenv('TRUSTED_PROXY_HOPS', '0'))
+# Status polls, event streams and static files stay unlimited
+ADMISSION_ENDPOINTS = {
+    'get_video_info', 'get_video_formats', 'download_video', 'download_timestamped_video', 'download_thumbnail',
+    'create_job', 'get_job_file', 'batch_info', 'batch_download',
+}
+
+if TRUSTED_PROXY_HOPS:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
+
+class ClientLimiter:
+    def __init__(self, rate_per_minute, burst, max_concurrent):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_concurrent = max_concurrent
+        self._clients = {}  # client -> [tokens, last seen (monotonic), requests in flight]
+        self._lock = threading.Lock()
+
+    def admit(self, client):
+        """
+        Takes a token and an in-flight slot for `client`. Returns None when the
+        request may proceed, or `(reason, retry_after)` when it's refused.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._clients.setdefault(client, [self.burst, now, 0])
+            tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[0], state[1] = tokens, now
+            if self.max_concurrent and state[2] >= self.max_concurrent:
+                return 'concurrency', CLIENT_CONCURRENCY_RETRY_AFTER
+            if self.rate and tokens < 1:
+                return 'rate', int((1 - tokens) / self.rate) + 1
+            state[0] -= 1
+            state[2] += 1
+            return None
+
+    def charge(self, client, cost):
+        """
+        Takes `cost` more tokens from an admitted `client`, letting the bucket go
+        negative. Returns None, or `('rate', retry_after)` if the bucket was
+        already overdrawn.
+        """
+        now = time.monotonic()
+        with self._lock:
+            state = self._clients.setdefault(client, [self.burst, now, 0])
+            tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+            state[0], state[1] = tokens, now
+            if not self.rate:
+                return None
+            if tokens < 0:
+                return 'rate', int((1 - tokens) / self.rate) + 1
+            state[0] -= cost
+            return None
+
+    def release(self, client):
+        with self._lock:
+            state = self._clients.get(client)
+            if state:
+                state[2] -= 1
+
+    def prune(self):
+        cutoff = time.monotonic() - CLIENT_IDLE_TTL
+        with self._lock:
+            for client, state in list(self._clients.items()):
+                if not state[2] and state[1] < cutoff:
+                    del self._clients[client]
+
+    def stats(self):
+        with self._lock:
+            return [
+                ('admission_clients', (), len(self._clients)),
+                ('admission_in_flight', (), sum(state[2] for state in self._clients.values())),
+            ]
+
+
+client_limiter = ClientLimiter(CLIENT_RATE_LIMIT, CLIENT_RATE_BURST, CLIENT_MAX_CONCURRENT)
+janitor.every(CLIENT_IDLE_TTL, client_limiter.prune, delay=CLIENT_IDLE_TTL)
+metrics.add_gauges(client_limiter.stats)
+
+
+@app.before_request
+def admit_client():
+    if request.endpoint not in ADMISSION_ENDPOINTS:
+        return None
+    client = request.remote_addr or 'unknown'
+    refused = client_limiter.admit(client)
+    if refused:
+        return admission_refused_response(*refused)
+    g.admitted_client = client
+    return None
+
+
+def admission_refused_response(reason, retry_after):
+    metrics.inc('admission_rejections_total', reason=reason)
+    if reason == 'concurrency':
+        message = "Too many requests in progress from your address. Please wait for one to finish and try again."
+    else:
+        message = "Too many requests from your address. Please slow down and try again shortly."
+    response = jsonify({"error": message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def charge_batch_items(count):
+    """Charges the current client for a batch of `count` items; returns a 429 response if refused."""
+    client = g.get('admitted_client')
+    if client is None:
+        return None
+    refused = client_limiter.charge(client, count - 1)  # admission already took one token
+    return admission_refused_response(*refused) if refused else None
+
+
+@app.after_request
+def hold_admission_until_sent(response):
+    client = g.pop('admitted_client', None)
+    if client is None:
+        return response
+    sent_file = g.pop('sent_file', None)
+    if sent_file is not None and response.direct_passthrough:
+        # Wrapping a file body would hide it from the server's sendfile()
+        sent_file.call_on_close(lambda: client_limiter.release(client))
+    elif response.is_streamed:
+        # Released once the server closes the body, i.e. after the last byte is sent
+        response.response = ClosingIterator(response.response, lambda: client_limiter.release(client))
+    else:
+        client_limiter.release(client)
+    return response
+
+
+@app.teardown_request
+def release_admission(exc):
+    # Only still set when the request failed before after_request ran
+    client = g.pop('admitted_client', None)
+    if client is not None:
+        client_limiter.release(client)
+# --- END: CLIENT ADMISSION ---
+
+# --- START: STREAMING DOWNLOADS ---
+# With `"stream": true`, /download_video skips the download-to-disk step: ffmpeg
+# reads the selected stream(s) straight from the origin, copies (never
+# re-encodes) them into a container that can be written front to back
+# (fragmented MP4 or WebM), and its stdout is relayed to the client as a
+# chunked response. The generator only reads the pipe when the server asks for
+# the next chunk, so a slow client stalls ffmpeg instead of piling data up in
+# memory. Anything that needs seekable output or a transcode (codecs the
+# container can't hold, non-HTTP protocols) falls back to the staged download.
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAMABLE_PROTOCOLS = ('http', 'https', 'm3u8', 'm3u8_native')
+FRAGMENTED_MP4_FLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+
+def resolve_stream_formats(video_url, format_id, file_ext):
+    """
+    Resolves the formats yt-dlp would download for this request and returns
+    them if they can be muxed into `file_ext` on the fly, or None when the
+    request has to go through the staged download path.
+    """
+    container = CONTAINER_CODECS.get(file_ext)
+    if container is None:
+        return None
+    _, video_codecs, audio_codecs = container
+
+    with ydl_pool.borrow(download_profile(file_ext), format=select_download_format(format_id, file_ext)) as ydl:
+        info, _ = resolve_download_info(ydl, video_url)
+
+    formats = info.get('requested_formats') or [info]
+    for f in formats:
+        if not f.get('url') or f.get('protocol') not in STREAMABLE_PROTOCOLS:
+            return None
+        if not codec_fits(f.get('vcodec'), video_codecs) or not codec_fits(f.get('acodec'), audio_codecs):
+            return None
+    return formats
+
+
+def build_stream_command(formats, file_ext):
+    muxer = CONTAINER_CODECS[file_ext][0]
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-nostdin']
+    proxy_url = os.environ.get('PROXY_URL')
+    for f in formats:
+        headers = ''.join(f"{name}: {value}\r\n" for name, value in (f.get('http_headers') or {}).items())
+        if headers:
+            command += ['-headers', headers]
+        if proxy_url and f.get('protocol') in ('http', 'https'):
+            command += ['-http_proxy', proxy_url]
+        command += ['-i', f['url']]
+
+    if len(formats) == 1:
+        command += ['-map', '0']
+    else:
+        # yt-dlp lists the video format first when it merges video+audio
+        command += ['-map', '0:v:0', '-map', '1:a:0']
+    command += ['-c', 'copy', '-f', muxer]
+    if muxer == 'mp4':
+        command += ['-movflags', FRAGMENTED_MP4_FLAGS]
+    return command + ['pipe:1']
+
+
+def start_stream(formats, file_ext):
+    """
+    Starts ffmpeg and waits for its first chunk of output. Returns a generator
+    over the whole output, or None if ffmpeg could not be started or produced
+    nothing (so the caller can fall back to the staged path while it can still
+    send a proper error).
+    """
+    # ffmpeg opens one connection per input; it ignores bandwidth shares
+    transfer = transfer_scheduler.acquire(formats=formats, connections=len(formats))
+    stderr_file = tempfile.TemporaryFile()
+    try:
+        process = subprocess.Popen(build_stream_command(formats, file_ext),
+                                   stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=stderr_file)
+    except OSError as e:
+        transfer_scheduler.release(transfer)
+        stderr_file.close()
+        print(f"ERROR: Could not start streaming ffmpeg: {e}")
+        return None
+    first_chunk = process.stdout.read(STREAM_CHUNK_SIZE)
+    if not first_chunk:
+        process.wait()
+        transfer_scheduler.release(transfer)
+        stderr_file.seek(0)
+        print(f"ERROR: Streaming ffmpeg exited with {process.returncode}: {stderr_file.read().decode('utf-8', 'replace').strip()}")
+        stderr_file.close()
+        return None
+
+    started = time.perf_counter()
+
+    def generate():
+        try:
+            yield first_chunk
+            while chunk := process.stdout.read(STREAM_CHUNK_SIZE):
+                yield chunk
+            if process.wait() != 0:
+                stderr_file.seek(0)
+                # Raising aborts the chunked response so the client sees a failed transfer
+                raise Exception(f"ffmpeg exited with {process.returncode}: {stderr_file.read().decode('utf-8', 'replace').strip()}")
+        finally:
+            if process.poll() is None:
+                process.kill()  # Client went away mid-stream
+                process.wait()
+            process.stdout.close()
+            stderr_file.close()
+            transfer_scheduler.release(transfer)
+            metrics.observe('stage_duration_seconds', time.perf_counter() - started, stage='stream')
+
+    return generate()
+# --- END: STREAMING DOWNLOADS ---
+
 
 @app.route('/')
 def home():
     return render_template('index.html')
 
+SUMMARY_FIELDS = ('title', 'thumbnail', 'hd_thumbnail', 'channel', 'duration', 'views')
+# Top-level info fields a download needs to re-process a stored extraction;
+# everything else (description, subtitles, thumbnails, the last format
+# selection...) is left out of the format index
+DOWNLOAD_INFO_FIELDS = (
+    '_type', 'id', 'display_id', 'title', 'fulltitle', 'formats', '_format_sort_fields', 'http_headers', 'direct',
+    'extractor', 'extractor_key', 'webpage_url', 'original_url', 'webpage_url_basename', 'webpage_url_domain',
+    'duration', 'is_live', 'was_live', 'live_status', 'timestamp', 'release_timestamp', 'upload_date',
+    'uploader', 'channel', 'view_count', 'age_limit', 'availability',
+)
+YOUTUBE_OEMBED_URL = 'https://www.youtube.com/oembed'
+OEMBED_TIMEOUT = (3, 5)  # connect, read (seconds); a slow answer falls back to the full extraction anyway
+
+
+def summarize_info(info):
+    """Reduces a yt-dlp info dict to the summary fields shown before the format lists."""
+    video_title = info.get('title', 'N/A')
+    thumbnail_url = info.get('thumbnail', 'N/A')
+    channel = info.get('uploader', 'N/A')
+    duration = info.get('duration', 0)
+    view_count = info.get('view_count', 0)
+
+    high_res_thumbnail = thumbnail_url
+    if 'thumbnails' in info and info['thumbnails']:
+        sorted_thumbnails = sorted(info['thumbnails'], key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)
+        if sorted_thumbnails:
+            high_res_thumbnail = sorted_thumbnails[0].get('url', thumbnail_url)
+
+    return {
+        "title": video_title,
+        "thumbnail": thumbnail_url,
+        "hd_thumbnail": high_res_thumbnail,
+        "channel": channel,
+        "duration": duration,
+        "views": view_count,
+    }
+
+
+def build_format_lists(info):
+    """Builds the video and audio format lists behind the quality dropdowns."""
+    video_formats = []
+    audio_formats = []
+
+    seen_video_qualities = set()
+    seen_audio_qualities = set()
+
+    if 'formats' in info:
+        for f in info['formats']:
+            # Combined formats (video+audio)
+            if f.get('vcodec') != 'none' and f.get('acodec') != 'none' and f.get('height'):
+                quality_label = f'{f.get("height")}p MP4 (Combined)'
+                if quality_label not in seen_video_qualities:
+                    video_formats.append({
+                        'format_id': f.get('format_id'),
+                        'quality': quality_label,
+                        'ext': f.get('ext', 'mp4'),
+                        'filesize': f.get('filesize'),
+                        'vcodec': f.get('vcodec'),
+                        'acodec': f.get('acodec')
+                    })
+                    seen_video_qualities.add(quality_label)
+
+            # Video-only streams
+            elif f.get('vcodec') != 'none' and f.get('acodec') == 'none' and f.get('height'):
+                quality_label = f'{f.get("height")}p MP4' # Will be merged with audio
+                if quality_label not in seen_video_qualities:
+                    video_formats.append({
+                        'format_id': f.get('format_id'),
+                        'quality': quality_label,
+                        'ext': 'mp4', # Assumed output after merge
+                        'filesize': f.get('filesize'), # Video stream filesize
+                        'vcodec': f.get('vcodec'),
+                        'acodec': f.get('acodec')
+                    })
+                    seen_video_qualities.add(quality_label)
+
+            # Audio-only streams
+            elif f.get('acodec') != 'none' and f.get('vcodec') == 'none':
+                quality_label = ''
+                if f.get('ext') == 'mp3':
+                    quality_label = 'Audio Only MP3'
+                elif f.get('ext') == 'm4a':
+                    quality_label = 'Audio Only M4A'
+                elif f.get('ext') == 'webm' and f.get('acodec') == 'opus':
+                     quality_label = 'Audio Only Opus (WebM)'
+
+                if quality_label and quality_label not in seen_audio_qualities:
+                    audio_formats.append({
+                        'format_id': f.get('format_id'),
+                        'quality': quality_label,
+                        'ext': f.get('ext'),
+                        'filesize': f.get('filesize'),
+                        'vcodec': f.get('vcodec'),
+                        'acodec': f.get('acodec')
+                    })
+                    seen_audio_qualities.add(quality_label)
+
+    if not video_formats:
+        video_formats.append({
+            'format_id': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best',
+            'quality': 'Best Quality (MP4)',
+            'ext': 'mp4',
+            'filesize': None
+        })
+    if not audio_formats:
+        audio_formats.append({
+            'format_id': 'bestaudio[ext=mp3]/bestaudio',
+            'quality': 'Best Audio (MP3)',
+            'ext': 'mp3',
+            'filesize': None
+        })
+        audio_formats.append({
+            'format_id': 'bestaudio',
+            'quality': 'Best Audio (Original)',
+            'ext': 'm4a',
+            'filesize': None
+        })
+
+    video_formats.sort(key=lambda x: int(x['quality'].split('p')[0]) if 'p' in x['quality'] else -1, reverse=True)
+    audio_formats.sort(key=lambda x: x['quality'])
+
+    return video_formats, audio_formats
+
+
+def extract_video_info(video_url):
+    """
+    Runs yt-dlp metadata extraction for `video_url` and builds its format index:
+    the JSON payload served by /video_formats (summary fields plus the
+    video/audio format lists used by the quality dropdowns) and, under
+    'download_info', the compacted extraction that downloads reuse.
+    """
+    with ydl_pool.borrow('info') as ydl:
+        with metrics.timed('extract_info'):
+            info = ydl.extract_info(video_url, download=False)
+
+    video_formats, audio_formats = build_format_lists(info)
+    download_info = yt_dlp.YoutubeDL.sanitize_info({field: info[field] for field in DOWNLOAD_INFO_FIELDS if field in info})
+    return dict(summarize_info(info), video_formats=video_formats, audio_formats=audio_formats, download_info=download_info)
+
+
+def public_video_info(video_info):
+    """A format index entry without the part only downloads use."""
+    return {key: value for key, value in video_info.items() if key != 'download_info'}
+
+
+def fetch_oembed_summary(youtube_id):
+    """
+    Describes a YouTube video from its oEmbed metadata: one small JSON request,
+    no player or format resolution. oEmbed has no duration or view count; those
+    arrive with the format index. Returns None when oEmbed can't describe the
+    video (private, embedding disabled...).
+    """
+    try:
+        response = http_session.get(YOUTUBE_OEMBED_URL, timeout=OEMBED_TIMEOUT, params={
+            'url': f'https://www.youtube.com/watch?v={youtube_id}',
+            'format': 'json',
+        })
+        if response.status_code != 200:
+            return None
+        data = response.json()
+    except (requests.exceptions.RequestException, ValueError):
+        return None
+
+    thumbnail_url = data.get('thumbnail_url') or f'https://i.ytimg.com/vi/{youtube_id}/hqdefault.jpg'
+    return {
+        "title": data.get('title', 'N/A'),
+        "thumbnail": thumbnail_url,
+        "hd_thumbnail": thumbnail_url,
+        "channel": data.get('author_name', 'N/A'),
+        "duration": None,
+        "views": None,
+    }
+
+
+def get_cached_video_info(video_url):
+    """
+    Returns `(video_info, cache_status, cache_source)` for `video_url`, serving
+    it from video_info_cache when possible and otherwise extracting it once
+    for all concurrent callers. cache_status is 'HIT', 'MISS' or 'COALESCED'.
+    """
+    cache_key = canonical_video_key(video_url)
+    cached_info, cache_source = video_info_cache.get(cache_key)
+    if cached_info is not None:
+        return cached_info, 'HIT', cache_source
+
+    def extract_and_cache():
+        video_info = extract_video_info(video_url)
+        video_info_cache.set(cache_key, video_info)
+        # The index has what oEmbed lacks (duration, views, best thumbnail)
+        video_summary_cache.set(public_video_id(cache_key), dict(
+            {field: video_info[field] for field in SUMMARY_FIELDS}, source_url=video_url))
+        return video_info
+
+    video_info, shared = info_flights.do(
+        cache_key,
+        extract_and_cache,
+        check=lambda: video_info_cache.get(cache_key)[0],
+    )
+    return video_info, 'COALESCED' if shared else 'MISS', None
+
+
+def get_cached_video_summary(video_url):
+    """
+    Returns `(summary, cache_status, cache_source)` for phase one of
+    /get_video_info. A video whose format index is cached is summarized from
+    it; other YouTube videos are described by oEmbed, and anything else (which
+    has no lighter source) gets its format index built right away.
+    """
+    cache_key = canonical_video_key(video_url)
+    video_id = public_video_id(cache_key)
+    cached_summary, cache_source = video_summary_cache.get(video_id)
+    if cached_summary is not None:
+        return cached_summary, 'HIT', cache_source
+
+    def summarize_and_cache():
+        video_info = video_info_cache.get(cache_key)[0]
+        summary = None
+        if video_info is None and cache_key.startswith('youtube:'):
+            summary = fetch_oembed_summary(video_id)
+        if summary is None:
+            if video_info is None:
+                video_info, _, _ = get_cached_video_info(video_url)
+            summary = {field: video_info[field] for field in SUMMARY_FIELDS}
+        summary['source_url'] = video_url
+        video_summary_cache.set(video_id, summary)
+        return summary
+
+    summary, shared = info_flights.do(
+        f'summary|{cache_key}',
+        summarize_and_cache,
+        check=lambda: video_summary_cache.get(video_id)[0],
+    )
+    return summary, 'COALESCED' if shared else 'MISS', None
+
+
+def revalidatable_json(payload):
+    """
+    JSON response with an ETag of its body, or an empty 304 when the request's
+    If-None-Match already names it. Unlike make_conditional this also answers
+    POSTs: the web UI revalidates its cached /get_video_info lookups that way.
+    """
+    response = jsonify(payload)
+    response.add_etag()
+    etag, _ = response.get_etag()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+    # Browsers may keep it, but must check back before reusing it
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+def describe_info_error(error_message):
+    """Maps a yt-dlp DownloadError raised during metadata extraction to `(error, status_code)`."""
+    category = classify_download_error(error_message)
+    metrics.inc('errors_total', category=category)
+    # Check for bot detection specifically and return a helpful message
+    if category == 'bot_detection':
+        print(f"yt-dlp error: Bot detection suspected: {error_message}")
+        return BOT_DETECTION_ERROR, 500
+    elif category == 'age_restricted':
+        return "This video is age-restricted and cannot be downloaded directly.", 403
+    elif category == 'private':
+        return "This video is private and cannot be accessed.", 403
+    elif category == 'unavailable':
+        return "This video is unavailable or has been deleted.", 404
+    else:
+        print(f"yt-dlp error: {error_message}")
+        return f"Could not retrieve video information. Please check the URL or try another one. Details: {error_message}", 500
+
+
 @app.route('/get_video_info', methods=['POST'])
 def get_video_info():
     data = request.get_json()
@@ -59,146 +2335,64 @@ def get_video_info():
         return jsonify({"error": "No URL provided"}), 400
 
     try:
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': True,
-            'force_generic_extractor': True,
-            'skip_download': True,
-            'format_sort': ['res', 'ext'],
-        }
-        
-        # --- ADDED: Include cookies if the file exists ---
-        if os.path.exists(COOKIES_FILE_PATH):
-            ydl_opts['cookiefile'] = COOKIES_FILE_PATH
-            print(f"DEBUG: Using cookies file for get_video_info: {COOKIES_FILE_PATH}")
-        # --- END ADDED ---
-
-        proxy_url = os.environ.get('PROXY_URL') 
-        # if proxy_url: # Comment this line out
-            #     ydl_opts['proxy'] = proxy_url # Comment this line out
-            #     print(f"DEBUG: Using proxy for get_video_info: {proxy_url}") # Comment this line out 
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=False)
-            
-            video_title = info.get('title', 'N/A')
-            thumbnail_url = info.get('thumbnail', 'N/A')
-            channel = info.get('uploader', 'N/A')
-            duration = info.get('duration', 0)
-            view_count = info.get('view_count', 0)
-
-            high_res_thumbnail = thumbnail_url
-            if 'thumbnails' in info and info['thumbnails']:
-                sorted_thumbnails = sorted(info['thumbnails'], key=lambda x: x.get('width', 0) * x.get('height', 0), reverse=True)
-                if sorted_thumbnails:
-                    high_res_thumbnail = sorted_thumbnails[0].get('url', thumbnail_url)
-
-            video_formats = []
-            audio_formats = []
-            
-            seen_video_qualities = set()
-            seen_audio_qualities = set()
-
-            if 'formats' in info:
-                for f in info['formats']:
-                    # Combined formats (video+audio)
-                    if f.get('vcodec') != 'none' and f.get('acodec') != 'none' and f.get('height'):
-                        quality_label = f'{f.get("height")}p MP4 (Combined)'
-                        if quality_label not in seen_video_qualities:
-                            video_formats.append({
-                                'format_id': f.get('format_id'),
-                                'quality': quality_label,
-                                'ext': f.get('ext', 'mp4'),
-                                'filesize': f.get('filesize')
-                            })
-                            seen_video_qualities.add(quality_label)
-                    
-                    # Video-only streams
-                    elif f.get('vcodec') != 'none' and f.get('acodec') == 'none' and f.get('height'):
-                        quality_label = f'{f.get("height")}p MP4' # Will be merged with audio
-                        if quality_label not in seen_video_qualities:
-                            video_formats.append({
-                                'format_id': f.get('format_id'),
-                                'quality': quality_label,
-                                'ext': 'mp4', # Assumed output after merge
-                                'filesize': f.get('filesize') # Video stream filesize
-                            })
-                            seen_video_qualities.add(quality_label)
-
-                    # Audio-only streams
-                    elif f.get('acodec') != 'none' and f.get('vcodec') == 'none':
-                        quality_label = ''
-                        if f.get('ext') == 'mp3':
-                            quality_label = 'Audio Only MP3'
-                        elif f.get('ext') == 'm4a':
-                            quality_label = 'Audio Only M4A'
-                        elif f.get('ext') == 'webm' and f.get('acodec') == 'opus':
-                             quality_label = 'Audio Only Opus (WebM)'
-                        
-                        if quality_label and quality_label not in seen_audio_qualities:
-                            audio_formats.append({
-                                'format_id': f.get('format_id'),
-                                'quality': quality_label,
-                                'ext': f.get('ext'),
-                                'filesize': f.get('filesize')
-                            })
-                            seen_audio_qualities.add(quality_label)
-            
-            if not video_formats:
-                video_formats.append({
-                    'format_id': 'bestvideo[ext=mp4]+bestaudio[ext=m4a]/best',
-                    'quality': 'Best Quality (MP4)',
-                    'ext': 'mp4',
-                    'filesize': None
-                })
-            if not audio_formats:
-                audio_formats.append({
-                    'format_id': 'bestaudio[ext=mp3]/bestaudio',
-                    'quality': 'Best Audio (MP3)',
-                    'ext': 'mp3',
-                    'filesize': None
-                })
-                audio_formats.append({
-                    'format_id': 'bestaudio',
-                    'quality': 'Best Audio (Original)',
-                    'ext': 'm4a',
-                    'filesize': None
-                })
-
-            video_formats.sort(key=lambda x: int(x['quality'].split('p')[0]) if 'p' in x['quality'] else -1, reverse=True)
-            audio_formats.sort(key=lambda x: x['quality'])
-
-            return jsonify({
-                "title": video_title,
-                "thumbnail": thumbnail_url,
-                "hd_thumbnail": high_res_thumbnail,
-                "channel": channel,
-                "duration": duration,
-                "views": view_count,
-                "video_formats": video_formats,
-                "audio_formats": audio_formats
-            })
+        summary, cache_status, cache_source = get_cached_video_summary(video_url)
+        cache_key = canonical_video_key(video_url)
+        video_id = public_video_id(cache_key)
+
+        video_info = {field: summary.get(field) for field in SUMMARY_FIELDS}
+        video_info.update(video_id=video_id, formats_url=url_for('get_video_formats', video_id=video_id))
+        indexed_info = video_info_cache.get(cache_key)[0]
+        if indexed_info is not None:
+            # Already indexed: send the format lists along and save the client the second request
+            video_info.update(public_video_info(indexed_info))
+
+        response = revalidatable_json(video_info)
+        response.headers['X-Cache'] = cache_status
+        if cache_source:
+            response.headers['X-Cache-Source'] = cache_source
+        return response
 
     except yt_dlp.DownloadError as e:
-        error_message = str(e)
-        # Check for bot detection specifically and return a helpful message
-        if "Sign in to confirm you’re not a bot" in error_message or "Unable to extract video data" in error_message or "Please use --cookies-from-browser" in error_message:
-            print(f"yt-dlp error: Bot detection suspected: {error_message}")
-            return jsonify({"error": "YouTube detected bot activity. This might be due to missing or expired cookies. Please ensure YOUTUBE_COOKIES_BASE64 environment variable is correctly set up on Render with fresh cookies."}), 500
-        elif "age-restricted" in error_message:
-            return jsonify({"error": "This video is age-restricted and cannot be downloaded directly."}), 403
-        elif "private" in error_message:
-            return jsonify({"error": "This video is private and cannot be accessed."}), 403
-        elif "unavailable" in error_message or "deleted" in error_message:
-            return jsonify({"error": "This video is unavailable or has been deleted."}), 404
-        else:
-            print(f"yt-dlp error: {error_message}")
-            return jsonify({"error": f"Could not retrieve video information. Please check the URL or try another one. Details: {error_message}"}), 500
+        error_message, status_code = describe_info_error(str(e))
+        return jsonify({"error": error_message}), status_code
     except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
         print(f"General error in get_video_info: {e}")
         return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
 
+
+@app.route('/video_formats/<video_id>', methods=['GET'])
+def get_video_formats(video_id):
+    """
+    Phase two of the info API: the format index of a video looked up through
+    /get_video_info, built on first request and then cached (downloads of the
+    video reuse it instead of extracting again).
+    """
+    if YOUTUBE_ID_RE.match(video_id):
+        video_url = f'https://www.youtube.com/watch?v={video_id}'
+    else:
+        summary = video_summary_cache.get(video_id)[0]
+        if summary is None:
+            return jsonify({"error": "Unknown video ID. Look the video up with /get_video_info first."}), 404
+        video_url = summary['source_url']
+
+    try:
+        video_info, cache_status, cache_source = get_cached_video_info(video_url)
+
+        response = revalidatable_json(dict(public_video_info(video_info), video_id=video_id))
+        response.headers['X-Cache'] = cache_status
+        if cache_source:
+            response.headers['X-Cache-Source'] = cache_source
+        return response
+
+    except yt_dlp.DownloadError as e:
+        error_message, status_code = describe_info_error(str(e))
+        return jsonify({"error": error_message}), status_code
+    except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
+        print(f"General error in get_video_formats: {e}")
+        return jsonify({"error": f"An unexpected error occurred: {str(e)}"}), 500
+
 @app.route('/download_video', methods=['POST'])
 def download_video():
     data = request.get_json()
@@ -206,107 +2400,51 @@ def download_video():
     format_id = data.get('format_id')
     file_ext = data.get('ext') 
     video_title = data.get('title', 'video')
+    prefer_native = bool(data.get('prefer_native'))
 
     if not video_url or not format_id or not file_ext:
         return jsonify({"error": "Missing URL, format_id, or file extension"}), 400
 
-    sanitized_title = re.sub(r'[^\w\s-]', '', video_title).strip().replace(' ', '_')
-    if not sanitized_title:
-        sanitized_title = "download"
-
-    unique_id = uuid.uuid4().hex[:8]
-    download_filename = f"{sanitized_title}_{unique_id}.{file_ext}"
-    filepath = os.path.join(DOWNLOAD_DIR, download_filename)
-
     try:
-        proxy_url = os.environ.get('PROXY_URL')
-        
-        ydl_opts = {
-            'outtmpl': filepath,
-            'no_warnings': True,
-            'quiet': True,
-            'cachedir': False,
-            'noplaylist': True,
-            'postprocessors': []
-        }
-        
-        # --- ADDED: Include cookies if the file exists ---
-        if os.path.exists(COOKIES_FILE_PATH):
-            ydl_opts['cookiefile'] = COOKIES_FILE_PATH
-            print(f"DEBUG: Using cookies file for download_video: {COOKIES_FILE_PATH}")
-        # --- END ADDED ---
-
-        if proxy_url:
-            ydl_opts['proxy'] = proxy_url
-            print(f"DEBUG: Using proxy for download_video: {proxy_url}") 
-
-        if file_ext == 'mp4':
-            ydl_opts['format'] = f'{format_id}+bestaudio[ext=m4a]/best'
-            ydl_opts['merge_output_format'] = 'mp4'
-            ydl_opts['postprocessors'].append({
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4'
-            })
-        elif file_ext == 'mp3':
-            ydl_opts['format'] = format_id if 'audio' in format_id.lower() else 'bestaudio/best'
-            ydl_opts['postprocessors'].append({
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            })
-            ydl_opts['merge_output_format'] = 'mp3' 
-        else:
-            ydl_opts['format'] = format_id
-            ydl_opts['merge_output_format'] = file_ext
-
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info_dict = ydl.extract_info(video_url, download=True)
-            final_filepath = ydl.prepare_filename(info_dict)
-
-        if not os.path.exists(final_filepath):
-            raise Exception(f"Downloaded file not found on server at {final_filepath}.")
-
-        response = send_file(final_filepath, as_attachment=True, download_name=download_filename)
+        if data.get('stream'):
+            cached_path = download_cache.lookup(video_cache_key(video_url, format_id, file_ext), file_ext)
+            if cached_path:
+                return send_cached_file(cached_path, make_download_filename(video_title, file_ext), 'HIT')
 
-        def cleanup_file_delayed(path_to_clean):
-            if os.path.exists(path_to_clean):
-                try:
-                    os.remove(path_to_clean)
-                    print(f"Cleaned up: {path_to_clean}")
-                except OSError as e:
-                    print(f"Error cleaning up file {path_to_clean}: {e}")
-
-        threading.Timer(10, cleanup_file_delayed, args=[final_filepath]).start()
+            stream_formats = resolve_stream_formats(video_url, format_id, file_ext)
+            stream = start_stream(stream_formats, file_ext) if stream_formats else None
+            if stream is not None:
+                download_filename = make_download_filename(video_title, file_ext)
+                response = Response(stream, mimetype=mimetypes.guess_type(download_filename)[0] or 'application/octet-stream')
+                response.headers['Content-Disposition'] = attachment_disposition(download_filename)
+                response.headers['X-Download-Mode'] = 'stream'
+                return response
+            print(f"DEBUG: Streaming not possible for {format_id}/{file_ext}, using staged download")
 
+        filepath, download_filename, cache_status, plan = fetch_video_download(
+            video_url, format_id, file_ext, video_title, accept_stream=True, prefer_native=prefer_native)
+        if isinstance(filepath, GrowingFile):
+            # Another request is downloading this exact file; stream it as it grows
+            response = Response(filepath, mimetype=mimetypes.guess_type(download_filename)[0] or 'application/octet-stream')
+            response.headers['Content-Disposition'] = attachment_disposition(download_filename)
+            response.headers['X-Cache'] = cache_status
+            return response
+        response = send_cached_file(filepath, download_filename, cache_status)
+        if plan:
+            response.headers['X-Postprocess-Plan'] = json.dumps({k: plan[k] for k in ('action', 'output_ext', 'reason')})
         return response
 
     except yt_dlp.DownloadError as e:
-        error_message = str(e)
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
-        
-        if "Sign in to confirm you’re not a bot" in error_message or "Unable to extract video data" in error_message or "Please use --cookies-from-browser" in error_message:
-            print(f"yt-dlp download error: Bot detection suspected: {error_message}")
-            return jsonify({"error": "YouTube detected bot activity. This might be due to missing or expired cookies. Please ensure YOUTUBE_COOKIES_BASE64 environment variable is correctly set up on Render with fresh cookies."}), 500
-        if "FFmpeg" in error_message:
-            return jsonify({"error": "FFmpeg is required for this download. Please ensure it's installed and in your system PATH."}), 500
-        if "age-restricted" in error_message:
-            return jsonify({"error": "This video is age-restricted and cannot be downloaded directly."}), 403
-        elif "private" in error_message:
-            return jsonify({"error": "This video is private and cannot be accessed."}), 403
-        elif "unavailable" in error_message or "deleted" in error_message:
-            return jsonify({"error": "This video is unavailable or has been deleted."}), 404
-        elif "No such format" in error_message:
-            return jsonify({"error": "The requested format is not available for this video."}), 400
-        else:
-            print(f"yt-dlp download error: {error_message}")
-            return jsonify({"error": f"Failed to download video. Details: {error_message}"}), 500
+        error_message, status_code = describe_download_error(str(e), 'download video')
+        return jsonify({"error": error_message}), status_code
+    except InsufficientDiskSpace as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(DISK_RETRY_AFTER)
+        return response
     except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
         print(f"General download error: {e}")
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
         return jsonify({"error": f"An unexpected error occurred during download: {str(e)}"}), 500
 
 @app.route('/download_timestamped_video', methods=['POST'])
@@ -316,91 +2454,131 @@ def download_timestamped_video():
     start_time = data.get('start_time')
     end_time = data.get('end_time')
     video_title = data.get('title', 'video')
+    fast_cut = bool(data.get('fast_cut'))
 
-    if not video_url or not start_time or not end_time:
+    if not video_url or start_time in (None, '') or end_time in (None, ''):
         return jsonify({"error": "Missing URL, start time, or end time"}), 400
+    segment = parse_segment_times(start_time, end_time)
+    if segment is None:
+        return jsonify({"error": "Invalid start or end time. The end time must be after the start time."}), 400
 
-    sanitized_title = re.sub(r'[^\w\s-]', '', video_title).strip().replace(' ', '_')
-    if not sanitized_title:
-        sanitized_title = "download"
+    try:
+        filepath, download_filename, cache_status = fetch_segment_download(video_url, *segment, video_title, fast_cut=fast_cut)
+        return send_cached_file(filepath, download_filename, cache_status)
 
-    unique_id = uuid.uuid4().hex[:8]
-    download_filename = f"{sanitized_title}_segment_{unique_id}.mp4" 
-    filepath = os.path.join(DOWNLOAD_DIR, download_filename)
+    except yt_dlp.DownloadError as e:
+        error_message, status_code = describe_download_error(str(e), 'download video segment')
+        return jsonify({"error": error_message}), status_code
+    except InsufficientDiskSpace as e:
+        response = jsonify({"error": str(e)})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(DISK_RETRY_AFTER)
+        return response
+    except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
+        print(f"General download error for segment: {e}")
+        return jsonify({"error": f"An unexpected error occurred during segment download: {str(e)}"}), 500
 
-    try:
-        proxy_url = os.environ.get('PROXY_URL')
-        
-        ydl_opts = {
-            'format': 'bestvideo+bestaudio/best',
-            'outtmpl': filepath,
-            'merge_output_format': 'mp4',
-            'no_warnings': True,
-            'quiet': True,
-            'cachedir': False,
-            'noplaylist': True,
-            'postprocessors': [{
-                'key': 'FFmpegPostprocessor',
-                'args': [
-                    '-ss', str(start_time),
-                    '-to', str(end_time)
-                ]
-            }],
-        }
-        
-        # --- ADDED: Include cookies if the file exists ---
-        if os.path.exists(COOKIES_FILE_PATH):
-            ydl_opts['cookiefile'] = COOKIES_FILE_PATH
-            print(f"DEBUG: Using cookies file for download_timestamped_video: {COOKIES_FILE_PATH}")
-        # --- END ADDED ---
+# --- ADDED download_thumbnail ROUTE HERE ---
+# Thumbnails are relayed from upstream straight to the client (nothing is
+# staged on disk) and kept in a size-bounded in-memory LRU keyed by thumbnail
+# URL. Responses carry an ETag (upstream's, or a hash of the bytes) and
+# Last-Modified, so GET requests revalidate with If-None-Match /
+# If-Modified-Since and get a 304 without an upstream call. Entries older than
+# THUMBNAIL_CACHE_TTL are revalidated upstream with the same validators.
+THUMBNAIL_CACHE_MAX_BYTES = int(os.getenv('THUMBNAIL_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+THUMBNAIL_MAX_CACHED_BYTES = 2 * 1024 * 1024  # larger images are relayed but not cached
+THUMBNAIL_CACHE_TTL = int(os.getenv('THUMBNAIL_CACHE_TTL', '3600'))  # seconds
 
-        if proxy_url:
-            ydl_opts['proxy'] = proxy_url
-            print(f"DEBUG: Using proxy for download_timestamped_video: {proxy_url}") 
 
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_url])
+class ByteLRUCache:
+    """Thread-safe LRU of byte payloads, bounded by their total size."""
 
-        if not os.path.exists(filepath):
-            raise Exception("Downloaded segment file not found on server.")
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
 
-        response = send_file(filepath, as_attachment=True, download_name=download_filename)
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
 
-        def cleanup_file_delayed(path_to_clean):
-            if os.path.exists(path_to_clean):
-                try:
-                    os.remove(path_to_clean)
-                    print(f"Cleaned up: {path_to_clean}")
-                except OSError as e:
-                    print(f"Error cleaning up file {path_to_clean}: {e}")
+    def set(self, key, entry):
+        """Stores `entry` (a dict whose 'body' is bytes) under `key`."""
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.size -= len(previous['body'])
+            self._entries[key] = entry
+            self.size += len(entry['body'])
+            while self.size > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted['body'])
 
-        threading.Timer(10, cleanup_file_delayed, args=[filepath]).start()
 
-        return response
+thumbnail_cache = ByteLRUCache(THUMBNAIL_CACHE_MAX_BYTES)
 
-    except yt_dlp.DownloadError as e:
-        error_message = str(e)
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
-        
-        if "Sign in to confirm you’re not a bot" in error_message or "Unable to extract video data" in error_message or "Please use --cookies-from-browser" in error_message:
-            print(f"yt-dlp timestamped download error: Bot detection suspected: {error_message}")
-            return jsonify({"error": "YouTube detected bot activity. This might be due to missing or expired cookies. Please ensure YOUTUBE_COOKIES_BASE64 environment variable is correctly set up on Render with fresh cookies."}), 500
-        if "FFmpeg" in error_message:
-            return jsonify({"error": "FFmpeg is required for timestamped downloads. Please ensure it's installed and in your system PATH."}), 500
-        return jsonify({"error": f"Failed to download video segment. Details: {error_message}"}), 500
-    except Exception as e:
-        print(f"General download error for segment: {e}")
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
-        return jsonify({"error": f"An unexpected error occurred during segment download: {str(e)}"}), 500
 
-# --- ADDED download_thumbnail ROUTE HERE ---
-@app.route('/download_thumbnail', methods=['POST'])
+def thumbnail_response(body, mimetype, download_filename, etag=None, last_modified=None):
+    response = Response(body, mimetype=mimetype)
+    response.headers['Content-Disposition'] = attachment_disposition(download_filename)
+    response.headers['Cache-Control'] = 'no-cache'  # let browsers keep it, but revalidate every time
+    if etag:
+        response.set_etag(etag)
+    if last_modified:
+        response.headers['Last-Modified'] = last_modified
+    return response
+
+
+def relay_thumbnail(thumbnail_url, upstream, download_filename):
+    """
+    Streams the `upstream` requests response to the client and caches the bytes
+    once the whole image has gone through (unless it is too large to cache).
+    """
+    mimetype = upstream.headers.get('Content-Type') or mimetypes.guess_type(download_filename)[0] or 'application/octet-stream'
+    upstream_etag = upstream.headers.get('ETag')
+    last_modified = upstream.headers.get('Last-Modified')
+    # Our ETag is derived from upstream's when it has one, so it is known before the body
+    etag = hashlib.sha1(upstream_etag.encode('utf-8')).hexdigest() if upstream_etag else None
+
+    def generate():
+        chunks = []
+        size = 0
+        try:
+            for chunk in upstream.iter_content(chunk_size=8192):
+                size += len(chunk)
+                if size <= THUMBNAIL_MAX_CACHED_BYTES:
+                    chunks.append(chunk)
+                yield chunk
+        finally:
+            upstream.close()
+            metrics.inc('bytes_in_total', size, source='thumbnail')
+        if size <= THUMBNAIL_MAX_CACHED_BYTES:
+            body = b''.join(chunks)
+            thumbnail_cache.set(thumbnail_url, {
+                'body': body,
+                'mimetype': mimetype,
+                'etag': etag or hashlib.sha1(body).hexdigest(),
+                'upstream_etag': upstream_etag,
+                'last_modified': last_modified,
+                'stored_at': time.time(),
+            })
+
+    response = thumbnail_response(generate(), mimetype, download_filename, etag=etag, last_modified=last_modified)
+    if upstream.headers.get('Content-Length') and not upstream.headers.get('Content-Encoding'):
+        response.headers['Content-Length'] = upstream.headers['Content-Length']
+    response.headers['X-Cache'] = 'MISS'
+    return response
+
+
+@app.route('/download_thumbnail', methods=['GET', 'POST'])
 def download_thumbnail():
-    data = request.get_json()
+    # GET (query string) requests can be revalidated; POST is kept for older clients
+    data = request.get_json() if request.method == 'POST' else request.args
     thumbnail_url = data.get('thumbnail_url')
     video_title = data.get('video_title', 'thumbnail')
 
@@ -411,9 +2589,7 @@ def download_thumbnail():
     if proxy_url:
         print(f"DEBUG: Using proxy for download_thumbnail via requests: {proxy_url}")
 
-    sanitized_title = re.sub(r'[^\w\s-]', '', video_title).strip().replace(' ', '_')
-    if not sanitized_title:
-        sanitized_title = "thumbnail"
+    sanitized_title = sanitize_title(video_title, "thumbnail")
 
     unique_id = uuid.uuid4().hex[:8]
     file_ext = thumbnail_url.split('.')[-1].split('?')[0] 
@@ -421,52 +2597,597 @@ def download_thumbnail():
         file_ext = 'jpg' 
 
     download_filename = f"{sanitized_title}_HD_Thumbnail_{unique_id}.{file_ext}"
-    filepath = os.path.join(DOWNLOAD_DIR, download_filename)
-
-    try:
-        # requests automatically uses HTTP_PROXY/HTTPS_PROXY environment variables
-        # so if PROXY_URL is set as such in Render, requests will use it implicitly.
-        response = requests.get(thumbnail_url, stream=True)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        with open(filepath, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        if not os.path.exists(filepath):
-            raise Exception("Thumbnail file not downloaded on server.")
-
-        mimetype = mimetypes.guess_type(filepath)[0] or 'application/octet-stream'
 
-        response = send_file(filepath, as_attachment=True, download_name=download_filename, mimetype=mimetype)
+    cached = thumbnail_cache.get(thumbnail_url)
+    upstream_headers = {}
+    if cached and time.time() - cached['stored_at'] >= THUMBNAIL_CACHE_TTL:
+        # Stale: ask upstream whether our copy is still current
+        if cached['upstream_etag']:
+            upstream_headers['If-None-Match'] = cached['upstream_etag']
+        if cached['last_modified']:
+            upstream_headers['If-Modified-Since'] = cached['last_modified']
+        if not upstream_headers:
+            cached = None
 
-        def cleanup_file_delayed(path_to_clean):
-            if os.path.exists(path_to_clean):
-                try:
-                    os.remove(path_to_clean)
-                    print(f"Cleaned up: {path_to_clean}")
-                except OSError as e:
-                    print(f"Error cleaning up file {path_to_clean}: {e}")
+    try:
+        upstream = None
+        if cached and upstream_headers:
+            # requests automatically uses HTTP_PROXY/HTTPS_PROXY environment variables
+            # so if PROXY_URL is set as such in Render, requests will use it implicitly.
+            upstream = http_session.get(thumbnail_url, stream=True, headers=upstream_headers, timeout=HTTP_TIMEOUT)
+            if upstream.status_code == 304:
+                upstream.close()
+                upstream = None
+                cached = dict(cached, stored_at=time.time())
+                thumbnail_cache.set(thumbnail_url, cached)
+            else:
+                cached = None
 
-        threading.Timer(10, cleanup_file_delayed, args=[filepath]).start()
+        if cached:
+            response = thumbnail_response(cached['body'], cached['mimetype'], download_filename,
+                                          etag=cached['etag'], last_modified=cached['last_modified'])
+            response.headers['X-Cache'] = 'HIT'
+            return response.make_conditional(request)
 
-        return response
+        if upstream is None:
+            upstream = http_session.get(thumbnail_url, stream=True, timeout=HTTP_TIMEOUT)
+        try:
+            upstream.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
+        except requests.exceptions.RequestException:
+            upstream.close()
+            raise
+        return relay_thumbnail(thumbnail_url, upstream, download_filename)
 
     except requests.exceptions.RequestException as e:
         print(f"Error downloading thumbnail from URL: {e}")
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
         return jsonify({"error": f"Failed to fetch thumbnail from URL: {str(e)}"}), 500
     except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
         print(f"General thumbnail download error: {e}")
-        if os.path.exists(filepath):
-            try: os.remove(filepath)
-            except OSError: pass
         return jsonify({"error": f"An unexpected error occurred during thumbnail download: {str(e)}"}), 500
 
 # --- END OF download_thumbnail ROUTE ---
 
+# --- START: DOWNLOAD JOBS ---
+# Downloads submitted through /jobs run on a fixed-size thread pool instead of
+# inside the HTTP request, so a gunicorn worker is only tied up for as long as
+# it takes to enqueue the job. Job state is mirrored as JSON under
+# DOWNLOAD_DIR/.jobs so whichever worker receives a status request can answer it.
+# The pool and its queue belong to the gunicorn worker process that accepted the
+# job, so both limits are per worker: a deployment runs up to
+# WEB_CONCURRENCY * DOWNLOAD_WORKERS jobs at once and queues up to
+# WEB_CONCURRENCY * DOWNLOAD_QUEUE_LIMIT more.
+DOWNLOAD_WORKERS = int(os.getenv('DOWNLOAD_WORKERS', '2'))  # per gunicorn worker
+DOWNLOAD_QUEUE_LIMIT = int(os.getenv('DOWNLOAD_QUEUE_LIMIT', '8'))  # jobs waiting for a free thread, per gunicorn worker
+JOB_RETENTION = int(os.getenv('JOB_RETENTION', '600'))  # seconds a finished job keeps its file from being evicted
+JOB_RETRY_AFTER = int(os.getenv('JOB_RETRY_AFTER', '30'))  # seconds, sent with 429 responses
+JOB_PROGRESS_PERSIST_INTERVAL = 1.0  # seconds between progress writes to the shared state file
+JOB_PROGRESS_NOTIFY_INTERVAL = 0.25  # seconds between progress wake-ups of a job's event streams
+JOB_EVENTS_HEARTBEAT = 15  # seconds between SSE keep-alive comments
+JOB_DISK_WAIT = int(os.getenv('JOB_DISK_WAIT', '300'))  # seconds a job waits for disk space before failing
+JOBS_DIR = os.path.join(DOWNLOAD_DIR, '.jobs')
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+
+download_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS, thread_name_prefix='download-job')
+jobs = {}
+jobs_lock = threading.Lock()
+# One condition per job (all sharing jobs_lock), so a progress update only
+# wakes the /jobs/<id>/events streams of that job
+jobs_changed = {}
+jobs_persisted_at = {}
+jobs_notified_at = {}
+jobs_notify_pending = set()
+
+
+def job_state_path(job_id):
+    return os.path.join(JOBS_DIR, f"{job_id}.json")
+
+
+def update_job(job_id, persist=True, **changes):
+    """
+    Applies `changes` to a job and wakes up its event streams. Progress updates
+    pass `persist=False`; they wake the streams at most once every
+    JOB_PROGRESS_NOTIFY_INTERVAL seconds (the last one of a burst is delivered
+    by the janitor) and only reach the shared state file once every
+    JOB_PROGRESS_PERSIST_INTERVAL seconds.
+    """
+    now = time.time()
+    with jobs_lock:
+        job = jobs[job_id]
+        job.update(changes)
+        job['version'] = job.get('version', 0) + 1
+        snapshot = dict(job)
+        wait = jobs_notified_at.get(job_id, 0) + JOB_PROGRESS_NOTIFY_INTERVAL - now
+        if persist or wait <= 0:
+            jobs_notified_at[job_id] = now
+            jobs_notify_pending.discard(job_id)
+            jobs_changed[job_id].notify_all()
+        elif job_id not in jobs_notify_pending:
+            jobs_notify_pending.add(job_id)
+            janitor.schedule(wait, notify_job_change, job_id)
+        if not persist and now - jobs_persisted_at.get(job_id, 0) < JOB_PROGRESS_PERSIST_INTERVAL:
+            return snapshot
+        jobs_persisted_at[job_id] = now
+    write_json_atomic(job_state_path(job_id), snapshot)
+    return snapshot
+
+
+def notify_job_change(job_id):
+    """Delivers a progress update that update_job held back."""
+    with jobs_lock:
+        if job_id in jobs_notify_pending and job_id in jobs_changed:
+            jobs_notify_pending.discard(job_id)
+            jobs_notified_at[job_id] = time.time()
+            jobs_changed[job_id].notify_all()
+
+
+def load_job(job_id):
+    """Returns a copy of the job from this worker's registry, falling back to the shared state file."""
+    if not JOB_ID_RE.match(job_id):
+        return None
+    with jobs_lock:
+        job = jobs.get(job_id)
+        if job is not None:
+            return dict(job)
+    try:
+        with open(job_state_path(job_id), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def prune_jobs():
+    """
+    Forgets jobs that finished more than JOB_RETENTION seconds ago and releases
+    their hold on the cached file.
+    """
+    cutoff = time.time() - JOB_RETENTION
+    with jobs_lock:
+        expired = [jobs.pop(job_id) for job_id, job in list(jobs.items())
+                   if job.get('finished_at') and job['finished_at'] < cutoff]
+        for job in expired:
+            jobs_persisted_at.pop(job['id'], None)
+            jobs_notified_at.pop(job['id'], None)
+            jobs_notify_pending.discard(job['id'])
+            jobs_changed.pop(job['id']).notify_all()
+    for job in expired:
+        if job.get('filepath'):
+            download_cache.release(job['filepath'])
+        remove_file_quietly(job_state_path(job['id']))
+
+
+def sweep_job_files():
+    """Removes state files of jobs that no live worker is updating any more (e.g. after a crash)."""
+    with jobs_lock:
+        live = {f"{job_id}.json" for job_id in jobs}
+    cutoff = time.time() - 2 * JOB_RETENTION
+    for name in os.listdir(JOBS_DIR):
+        path = os.path.join(JOBS_DIR, name)
+        try:
+            if name not in live and os.stat(path).st_mtime < cutoff:
+                os.remove(path)
+                print(f"Janitor removed stale job file: {path}")
+        except OSError:
+            pass
+
+
+janitor.every(JANITOR_SWEEP_INTERVAL, sweep_job_files)
+
+
+def active_job_gauges():
+    with jobs_lock:
+        states = [job['state'] for job in jobs.values()]
+    return [('active_jobs', (('state', state),), states.count(state)) for state in (JOB_QUEUED, JOB_RUNNING)]
+
+
+metrics.add_gauges(active_job_gauges)
+
+
+def job_status_payload(job):
+    return {
+        "job_id": job['id'],
+        "type": job['type'],
+        "state": job['state'],
+        "created_at": job['created_at'],
+        "started_at": job.get('started_at'),
+        "finished_at": job.get('finished_at'),
+        "error": job.get('error'),
+        "progress": job.get('progress'),
+        "postprocess": job.get('postprocess'),
+        "download_name": job.get('download_name'),
+        "status_url": url_for('get_job', job_id=job['id']),
+        "file_url": url_for('get_job_file', job_id=job['id']),
+        "events_url": url_for('get_job_events', job_id=job['id']),
+    }
+
+
+def run_download_job(job_id):
+    job = update_job(job_id, state=JOB_RUNNING, started_at=time.time())
+
+    def report_progress(progress):
+        update_job(job_id, persist=False, progress=progress)
+
+    try:
+        plan = None
+        if job['type'] == 'segment':
+            filepath, download_name, _ = fetch_segment_download(**job['params'], progress_callback=report_progress,
+                                                                disk_wait=JOB_DISK_WAIT)
+        else:
+            filepath, download_name, _, plan = fetch_video_download(**job['params'], progress_callback=report_progress,
+                                                                    disk_wait=JOB_DISK_WAIT)
+    except yt_dlp.DownloadError as e:
+        action = 'download video segment' if job['type'] == 'segment' else 'download video'
+        error_message, status_code = describe_download_error(str(e), action)
+        update_job(job_id, state=JOB_FAILED, finished_at=time.time(), error=error_message, status_code=status_code)
+        janitor.schedule(JOB_RETENTION, prune_jobs)
+        return
+    except InsufficientDiskSpace as e:
+        update_job(job_id, state=JOB_FAILED, finished_at=time.time(), error=str(e), status_code=503)
+        janitor.schedule(JOB_RETENTION, prune_jobs)
+        return
+    except Exception as e:
+        metrics.inc('errors_total', category='unexpected')
+        print(f"General error in download job {job_id}: {e}")
+        update_job(job_id, state=JOB_FAILED, finished_at=time.time(),
+                   error=f"An unexpected error occurred during download: {str(e)}", status_code=500)
+        janitor.schedule(JOB_RETENTION, prune_jobs)
+        return
+
+    # The job keeps its reference on the cached file until prune_jobs() forgets it
+    update_job(job_id, state=JOB_FINISHED, finished_at=time.time(), filepath=filepath, download_name=download_name,
+               postprocess=plan and {k: plan[k] for k in ('action', 'output_ext', 'reason')})
+    janitor.schedule(JOB_RETENTION, prune_jobs)
+
+
+@app.route('/jobs', methods=['POST'])
+def create_job():
+    data = request.get_json() or {}
+    job_type = data.get('type', 'video')
+
+    if job_type == 'video':
+        params = {
+            'video_url': data.get('url'),
+            'format_id': data.get('format_id'),
+            'file_ext': data.get('ext'),
+            'video_title': data.get('title', 'video'),
+            'prefer_native': bool(data.get('prefer_native')),
+        }
+        if not params['video_url'] or not params['format_id'] or not params['file_ext']:
+            return jsonify({"error": "Missing URL, format_id, or file extension"}), 400
+    elif job_type == 'segment':
+        if not data.get('url') or data.get('start_time') in (None, '') or data.get('end_time') in (None, ''):
+            return jsonify({"error": "Missing URL, start time, or end time"}), 400
+        segment = parse_segment_times(data['start_time'], data['end_time'])
+        if segment is None:
+            return jsonify({"error": "Invalid start or end time. The end time must be after the start time."}), 400
+        params = {
+            'video_url': data['url'],
+            'start_time': segment[0],
+            'end_time': segment[1],
+            'video_title': data.get('title', 'video'),
+            'fast_cut': bool(data.get('fast_cut')),
+        }
+    else:
+        return jsonify({"error": f"Unknown job type: {job_type}"}), 400
+
+    job_id = uuid.uuid4().hex
+    with jobs_lock:
+        queued_jobs = sum(1 for job in jobs.values() if job['state'] == JOB_QUEUED)
+        if queued_jobs >= DOWNLOAD_QUEUE_LIMIT:
+            response = jsonify({"error": "The download queue is full. Please try again shortly."})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(JOB_RETRY_AFTER)
+            return response
+
+        job = {
+            'id': job_id,
+            'type': job_type,
+            'state': JOB_QUEUED,
+            'params': params,
+            'created_at': time.time(),
+        }
+        jobs[job_id] = job
+        jobs_changed[job_id] = threading.Condition(jobs_lock)
+        snapshot = dict(job)
+
+    write_json_atomic(job_state_path(job_id), snapshot)
+    download_executor.submit(run_download_job, job_id)
+    return jsonify(job_status_payload(snapshot)), 202
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(job_status_payload(job))
+
+
+@app.route('/jobs/<job_id>/file', methods=['GET'])
+def get_job_file(job_id):
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    if job['state'] == JOB_FAILED:
+        return jsonify({"error": job.get('error')}), job.get('status_code', 500)
+    if job['state'] != JOB_FINISHED:
+        return jsonify({"error": "The download is not finished yet.", "state": job['state']}), 409
+    if not download_cache.acquire(job['filepath']):
+        return jsonify({"error": "The downloaded file has expired. Please start the download again."}), 410
+
+    return send_cached_file(job['filepath'], job['download_name'])
+
+
+def wait_for_job_change(job_id, last_version, timeout):
+    """
+    Blocks until the job's version moves past `last_version` or `timeout`
+    elapses, then returns the current job (None if it's unknown). Jobs owned by
+    another worker are polled from the shared state file instead.
+    """
+    deadline = time.time() + timeout
+    with jobs_lock:
+        while job_id in jobs:
+            if jobs[job_id].get('version', 0) != last_version:
+                return dict(jobs[job_id])
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return dict(jobs[job_id])
+            jobs_changed[job_id].wait(remaining)
+
+    while True:
+        job = load_job(job_id)
+        if job is None or job.get('version', 0) != last_version or time.time() >= deadline:
+            return job
+        time.sleep(JOB_PROGRESS_PERSIST_INTERVAL)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def get_job_events(job_id):
+    """
+    Server-Sent Events stream of a job's progress. Sends a `progress` event
+    whenever the job changes and a final `finished` or `failed` event before
+    closing. Idle streams only hold a sleeping generator, so with the gevent
+    worker class thousands of them cost no more than their sockets.
+    """
+    job = load_job(job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+
+    def generate(job):
+        yield "retry: 3000\n\n"
+        last_version = None
+        while True:
+            if job is None:
+                yield f"event: failed\ndata: {json.dumps({'error': 'Job not found'})}\n\n"
+                return
+            if job.get('version', 0) != last_version:
+                last_version = job.get('version', 0)
+                payload = job_status_payload(job)
+                if job['state'] in (JOB_FINISHED, JOB_FAILED):
+                    yield f"event: {job['state']}\ndata: {json.dumps(payload)}\n\n"
+                    return
+                yield f"id: {last_version}\nevent: progress\ndata: {json.dumps(payload)}\n\n"
+            else:
+                yield ": keep-alive\n\n"
+            job = wait_for_job_change(job_id, last_version, JOB_EVENTS_HEARTBEAT)
+
+    response = Response(stream_with_context(generate(job)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+# --- END: DOWNLOAD JOBS ---
+
+# --- START: BATCH REQUESTS ---
+# /batch/info and /batch/download take a list of URLs or one playlist URL
+# (expanded with a flat extraction, so entries aren't resolved twice).
+# Metadata is extracted on a per-request thread pool capped at
+# BATCH_MAX_CONCURRENCY and each result is sent as one NDJSON line as soon as
+# it is ready. Bulk downloads go through the same cache and coalescing as
+# single downloads, and each finished file is copied into a ZIP that is
+# written straight into the chunked response: ZIP entries use data
+# descriptors, so nothing needs to seek and neither the archive nor the files
+# are held in memory.
+BATCH_MAX_ITEMS = int(os.getenv('BATCH_MAX_ITEMS', '50'))
+BATCH_MAX_CONCURRENCY = int(os.getenv('BATCH_MAX_CONCURRENCY', '4'))  # parallel extractions per request
+BATCH_DOWNLOAD_CONCURRENCY = int(os.getenv('BATCH_DOWNLOAD_CONCURRENCY', '2'))  # parallel downloads per ZIP
+ZIP_CHUNK_SIZE = 64 * 1024
+
+
+def expand_playlist(playlist_url):
+    """Returns up to BATCH_MAX_ITEMS `(url, title)` entries of a playlist (or channel) URL."""
+    with ydl_pool.borrow('playlist', playlistend=BATCH_MAX_ITEMS) as ydl, metrics.timed('extract_playlist'):
+        info = ydl.extract_info(playlist_url, download=False)
+    entries = []
+    for entry in info.get('entries') or [info]:
+        if not entry:
+            continue
+        url = entry.get('webpage_url') or entry.get('url')
+        if url:
+            entries.append((url, entry.get('title')))
+    return entries[:BATCH_MAX_ITEMS], info.get('title')
+
+
+def parse_batch_items(data):
+    """
+    Returns `(items, playlist_title)` for a batch request body holding either
+    `urls` (a list of URLs or item dicts with `url` and optional `format_id`,
+    `ext` and `title`) or a `playlist_url`. Raises ValueError for bad input.
+    """
+    if data.get('playlist_url'):
+        entries, playlist_title = expand_playlist(data['playlist_url'])
+        return [{'url': url, 'title': title} for url, title in entries], playlist_title
+
+    urls = data.get('urls')
+    if not isinstance(urls, list) or not urls:
+        raise ValueError("Provide a non-empty 'urls' list or a 'playlist_url'.")
+    if len(urls) > BATCH_MAX_ITEMS:
+        raise ValueError(f"A batch can hold at most {BATCH_MAX_ITEMS} URLs.")
+    items = [item if isinstance(item, dict) else {'url': item} for item in urls]
+    if not all(isinstance(item.get('url'), str) and item['url'] for item in items):
+        raise ValueError("Every batch item needs a URL.")
+    return items, None
+
+
+def batch_concurrency(data, limit):
+    try:
+        requested = int(data.get('concurrency') or limit)
+    except (TypeError, ValueError):
+        requested = limit
+    return max(1, min(requested, limit))
+
+
+def iter_completed(executor, fn, items, discard=None):
+    """
+    Submits `fn(item)` for every item and yields `(index, item, result, error)`
+    in completion order. If the consumer stops early (e.g. the client
+    disconnected), work that hasn't started is cancelled and `discard(result)`
+    is called for results that were or will be produced but never yielded.
+    """
+    futures = {executor.submit(fn, item): (index, item) for index, item in enumerate(items)}
+    pending = set(futures)
+    try:
+        for future in as_completed(futures):
+            pending.discard(future)
+            index, item = futures[future]
+            try:
+                yield index, item, future.result(), None
+            except Exception as e:
+                yield index, item, None, e
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        if discard:
+            for future in pending:
+                future.add_done_callback(
+                    lambda f: discard(f.result()) if not f.cancelled() and f.exception() is None else None)
+
+
+def batch_error_line(e, describe):
+    if isinstance(e, yt_dlp.DownloadError):
+        return describe(str(e))
+    if isinstance(e, InsufficientDiskSpace):
+        return str(e), 503
+    return f"An unexpected error occurred: {str(e)}", 500
+
+
+class ZipStreamSink:
+    """Write-only file object collecting what ZipFile writes until the response generator takes it."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+
+@app.route('/batch/info', methods=['POST'])
+def batch_info():
+    data = request.get_json() or {}
+    try:
+        items, playlist_title = parse_batch_items(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except yt_dlp.DownloadError as e:
+        error_message, status_code = describe_info_error(str(e))
+        return jsonify({"error": error_message}), status_code
+    refused = charge_batch_items(len(items))
+    if refused:
+        return refused
+
+    executor = ThreadPoolExecutor(max_workers=batch_concurrency(data, BATCH_MAX_CONCURRENCY), thread_name_prefix='batch-info')
+
+    def generate():
+        for index, item, result, error in iter_completed(executor, lambda item: get_cached_video_info(item['url']), items):
+            line = {"index": index, "url": item['url']}
+            if error is None:
+                video_info, cache_status, _ = result
+                line.update(info=public_video_info(video_info), cache=cache_status)
+            else:
+                line['error'], line['status'] = batch_error_line(error, describe_info_error)
+            yield json.dumps(line) + '\n'
+
+    response = Response(generate(), mimetype='application/x-ndjson')
+    response.headers['X-Batch-Count'] = str(len(items))
+    if playlist_title:
+        response.headers['X-Playlist-Title'] = quote(playlist_title)
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/batch/download', methods=['POST'])
+def batch_download():
+    data = request.get_json() or {}
+    try:
+        items, playlist_title = parse_batch_items(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except yt_dlp.DownloadError as e:
+        error_message, status_code = describe_info_error(str(e))
+        return jsonify({"error": error_message}), status_code
+    refused = charge_batch_items(len(items))
+    if refused:
+        return refused
+
+    default_ext = data.get('ext', 'mp4')
+
+    def download_item(item):
+        file_ext = item.get('ext') or default_ext
+        format_id = item.get('format_id') or ('bestaudio' if file_ext == 'mp3' else 'bestvideo')
+        # Name the file after the video when /batch/info (or /get_video_info) already saw it
+        known_info = video_info_cache.get(canonical_video_key(item['url']))[0] or {}
+        video_title = item.get('title') or known_info.get('title') or 'video'
+        filepath, download_name, _, _ = fetch_video_download(item['url'], format_id, file_ext, video_title)
+        return filepath, download_name
+
+    executor = ThreadPoolExecutor(max_workers=batch_concurrency(data, BATCH_DOWNLOAD_CONCURRENCY), thread_name_prefix='batch-download')
+
+    def generate():
+        sink = ZipStreamSink()
+        completed = iter_completed(executor, download_item, items, discard=lambda result: download_cache.release(result[0]))
+        failures = []
+        try:
+            with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+                for index, item, result, error in completed:
+                    if error is not None:
+                        message, _ = batch_error_line(error, lambda msg: describe_download_error(msg, 'download video'))
+                        failures.append(f"{item['url']}: {message}")
+                        continue
+                    filepath, download_name = result
+                    try:
+                        # Media is already compressed, so entries are stored as-is
+                        with open(filepath, 'rb') as source, archive.open(f"{index + 1:03d}_{download_name}", 'w', force_zip64=True) as entry:
+                            while chunk := source.read(ZIP_CHUNK_SIZE):
+                                entry.write(chunk)
+                                yield sink.take()
+                    finally:
+                        download_cache.release(filepath)
+                if failures:
+                    archive.writestr('errors.txt', '\n'.join(failures) + '\n')
+            yield sink.take()
+        finally:
+            completed.close()
+
+    archive_name = sanitize_title(playlist_title, 'batch') + f"_{uuid.uuid4().hex[:8]}.zip"
+    response = Response(generate(), mimetype='application/zip')
+    response.headers['Content-Disposition'] = attachment_disposition(archive_name)
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+# --- END: BATCH REQUESTS ---
+
 
 if __name__ == '__main__':
     # When running locally, you might want to call setup_cookies_file() manually
@@ -0,0 +1,353 @@
+"""
+Offline load test for the app's endpoints.
+
+Starts a local HTTP origin serving synthetic media generated with ffmpeg
+(an H.264/AAC MP4, a VP9/Opus WebM, an AAC M4A and a JPEG thumbnail) that
+yt-dlp's generic extractor resolves like any direct link. Then starts the app
+in a scratch directory (so its downloads/ starts empty) and drives each
+scenario with --concurrency parallel clients. No network access is needed.
+
+Per scenario it reports throughput (requests/s and MB/s), latency and
+time-to-first-byte percentiles, errors, and the server's peak RSS and
+downloads/ disk use, sampled while the scenario runs.
+
+Scenarios:
+  info_cold        /get_video_info, a distinct URL per request (cache misses)
+  info_warm        /get_video_info, one URL (cache hits)
+  download_cold    /download_video of the MP4, a distinct URL per request
+  download_warm    /download_video of the MP4, one URL (download cache hits)
+  download_stream  /download_video of the WebM with "stream": true
+  download_mp3     /download_video of the M4A as MP3 (transcode)
+  thumbnail        /download_thumbnail of the JPEG (in-memory cache hits)
+
+    python benchmarks/load_benchmark.py [--scenarios info_cold,download_cold]
+        [--concurrency 8] [--requests 50] [--server werkzeug|gunicorn|profile]
+        [--workers 2] [--worker-class gthread] [--origin-latency 0]
+        [--json] [--output results.json]
+
+--server profile runs gunicorn with the production gunicorn.conf.py (its
+worker class and worker count; override them with GUNICORN_WORKER_CLASS and
+WEB_CONCURRENCY). The per-client limits are switched off for every server,
+since all benchmark clients share one address.
+
+--origin-latency delays every origin response, to model the time spent waiting
+on a remote CDN, which is what the server's worker class has to overlap.
+
+Without ffmpeg, --fake-media serves random bytes with the right extensions;
+that still exercises extraction, caching and transfer, but scenarios that run
+ffmpeg (download_stream, download_mp3) will fail or fall back.
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+SCENARIOS = {
+    # name: (method, path, build request kwargs from (origin, index))
+    'info_cold': ('POST', '/get_video_info', lambda origin, i: {'json': {'url': f'{origin}/clip.mp4?n={i}'}}),
+    'info_warm': ('POST', '/get_video_info', lambda origin, i: {'json': {'url': f'{origin}/clip.mp4'}}),
+    'download_cold': ('POST', '/download_video', lambda origin, i: {'json': {
+        'url': f'{origin}/clip.mp4?n={i}', 'format_id': 'best', 'ext': 'mp4', 'title': 'bench'}}),
+    'download_warm': ('POST', '/download_video', lambda origin, i: {'json': {
+        'url': f'{origin}/clip.mp4', 'format_id': 'best', 'ext': 'mp4', 'title': 'bench'}}),
+    'download_stream': ('POST', '/download_video', lambda origin, i: {'json': {
+        'url': f'{origin}/clip.webm?n={i}', 'format_id': 'best', 'ext': 'webm', 'title': 'bench', 'stream': True}}),
+    'download_mp3': ('POST', '/download_video', lambda origin, i: {'json': {
+        'url': f'{origin}/clip.m4a?n={i}', 'format_id': 'bestaudio', 'ext': 'mp3', 'title': 'bench'}}),
+    'thumbnail': ('GET', '/download_thumbnail', lambda origin, i: {'params': {
+        'thumbnail_url': f'{origin}/thumb.jpg', 'video_title': 'bench'}}),
+}
+DEFAULT_SCENARIOS = 'info_cold,info_warm,download_cold,download_warm,thumbnail'
+
+MEDIA_COMMANDS = {
+    'clip.mp4': ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30', '-f', 'lavfi', '-i', 'sine=frequency=440',
+                 '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-movflags', '+faststart'],
+    'clip.webm': ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720:rate=30', '-f', 'lavfi', '-i', 'sine=frequency=440',
+                  '-c:v', 'libvpx-vp9', '-deadline', 'realtime', '-cpu-used', '8', '-c:a', 'libopus'],
+    'clip.m4a': ['-f', 'lavfi', '-i', 'sine=frequency=440', '-c:a', 'aac'],
+    'thumb.jpg': ['-f', 'lavfi', '-i', 'testsrc2=size=1280x720', '-frames:v', '1'],
+}
+FAKE_MEDIA_SIZES = {'clip.mp4': 8 * 1024 * 1024, 'clip.webm': 6 * 1024 * 1024, 'clip.m4a': 1024 * 1024, 'thumb.jpg': 100 * 1024}
+
+
+def generate_media(media_dir, duration, fake):
+    for name, args in MEDIA_COMMANDS.items():
+        path = os.path.join(media_dir, name)
+        if fake:
+            with open(path, 'wb') as f:
+                f.write(os.urandom(FAKE_MEDIA_SIZES[name]))
+            continue
+        length = [] if name == 'thumb.jpg' else ['-t', str(duration)]
+        subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y'] + args + length + [path], check=True)
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like a real CDN
+
+    def send_head(self):
+        time.sleep(self.server.latency)
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class OriginServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    latency = 0  # seconds before each response, like a remote origin's time to first byte
+
+    def handle_error(self, request, client_address):
+        pass  # yt-dlp routinely hangs up after probing a file
+
+
+def start_origin(media_dir, latency=0):
+    server = OriginServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=media_dir))
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_app(workdir, args):
+    port = free_port()
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, NO_PROXY='127.0.0.1,localhost', no_proxy='127.0.0.1,localhost',
+               CLIENT_RATE_LIMIT='0', CLIENT_MAX_CONCURRENT='0')
+    env.pop('PROXY_URL', None)
+    if args.server == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-b', f'127.0.0.1:{port}', '-w', str(args.workers),
+                   '-k', args.worker_class, '--timeout', '300', 'app:app']
+    elif args.server == 'profile':
+        command = [sys.executable, '-m', 'gunicorn', '-c', os.path.join(REPO_DIR, 'gunicorn.conf.py'),
+                   '-b', f'127.0.0.1:{port}', 'app:app']
+    else:
+        command = [sys.executable, '-c', f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log_file = open(os.path.join(workdir, 'server.log'), 'wb')
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + 60
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with {process.returncode}; see {log_file.name}")
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError("The app did not start within 60 seconds")
+
+
+def process_tree_rss(pid):
+    """Resident memory in bytes of `pid` and its descendants (Linux /proc)."""
+    total, stack = 0, [pid]
+    while stack:
+        current = stack.pop()
+        try:
+            with open(f'/proc/{current}/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f'/proc/{current}/task'):
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    stack.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            continue
+    return total
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class ResourceSampler:
+    """Samples the server's RSS and downloads/ size in the background and keeps the peaks."""
+
+    def __init__(self, pid, downloads_dir, interval=0.1):
+        self.pid = pid
+        self.downloads_dir = downloads_dir
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def _sample(self):
+        self.peak_rss = max(self.peak_rss, process_tree_rss(self.pid))
+        self.peak_disk = max(self.peak_disk, directory_size(self.downloads_dir))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self.interval)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def timed_request(session, method, url, kwargs):
+    """Returns (status, seconds to first body byte, total seconds, body bytes)."""
+    started = time.perf_counter()
+    with session.request(method, url, stream=True, timeout=300, **kwargs) as response:
+        first_byte = None
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+            size += len(chunk)
+        total = time.perf_counter() - started
+        return response.status_code, first_byte if first_byte is not None else total, total, size
+
+
+def run_scenario(name, base_url, origin, server_pid, downloads_dir, concurrency, count):
+    method, path, build = SCENARIOS[name]
+    if name.endswith('_warm') or name == 'thumbnail':
+        requests.request(method, base_url + path, timeout=300, **build(origin, 0))  # prime the caches
+
+    local = threading.local()
+
+    def one(index):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            return timed_request(local.session, method, base_url + path, build(origin, index))
+        except requests.RequestException:
+            return None, None, None, 0
+
+    # Each scenario numbers its URLs from its own offset so cold runs never hit another scenario's cache
+    first_index = 100000 * (1 + list(SCENARIOS).index(name))
+    with ResourceSampler(server_pid, downloads_dir) as sampler, ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(one, range(first_index, first_index + count)))
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r[0] is not None and r[0] < 400]
+    latencies = [r[2] for r in ok]
+    ttfbs = [r[1] for r in ok]
+    total_bytes = sum(r[3] for r in ok)
+    ms = lambda seconds: round(seconds * 1000, 1) if seconds is not None else None
+    return {
+        'scenario': name,
+        'requests': count,
+        'errors': count - len(ok),
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed else None,
+        'throughput_mb_s': round(total_bytes / elapsed / 1e6, 2) if elapsed else None,
+        'latency_ms': {'p50': ms(percentile(latencies, 50)), 'p95': ms(percentile(latencies, 95)), 'p99': ms(percentile(latencies, 99))},
+        'ttfb_ms': {'p50': ms(percentile(ttfbs, 50)), 'p95': ms(percentile(ttfbs, 95)), 'p99': ms(percentile(ttfbs, 99))},
+        'peak_rss_mb': round(sampler.peak_rss / 1e6, 1),
+        'peak_disk_mb': round(sampler.peak_disk / 1e6, 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', default=DEFAULT_SCENARIOS, help=f"comma-separated, from: {', '.join(SCENARIOS)}")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=50, help='requests per scenario')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of synthetic media')
+    parser.add_argument('--origin-latency', type=float, default=0, help='ms the origin waits before each response')
+    parser.add_argument('--server', choices=('werkzeug', 'gunicorn', 'profile'), default='werkzeug')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn workers')
+    parser.add_argument('--worker-class', default='gthread', help='gunicorn worker class (sync, gthread, gevent)')
+    parser.add_argument('--fake-media', action='store_true', help='serve random bytes instead of ffmpeg output')
+    parser.add_argument('--keep', action='store_true', help="keep the scratch directory (server.log, downloads/)")
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    scenarios = [name for name in args.scenarios.split(',') if name]
+    unknown = [name for name in scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    if not args.fake_media and not shutil.which('ffmpeg'):
+        parser.error("ffmpeg is needed to generate the media (or pass --fake-media)")
+
+    workdir = tempfile.mkdtemp(prefix='load-bench-')
+    media_dir = os.path.join(workdir, 'origin')
+    os.makedirs(media_dir)
+    origin_server = app_process = None
+    try:
+        generate_media(media_dir, args.duration, args.fake_media)
+        origin_server, origin = start_origin(media_dir, args.origin_latency / 1000)
+        app_process, base_url = start_app(workdir, args)
+        results = [run_scenario(name, base_url, origin, app_process.pid, os.path.join(workdir, 'downloads'),
+                                args.concurrency, args.requests)
+                   for name in scenarios]
+    finally:
+        if app_process is not None:
+            app_process.terminate()
+            try:
+                app_process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                app_process.kill()
+        if origin_server is not None:
+            origin_server.shutdown()
+        if args.keep:
+            print(f"Scratch directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'server': f'gunicorn -w {args.workers} -k {args.worker_class}' if args.server == 'gunicorn' else args.server,
+        'fake_media': args.fake_media,
+        'media_seconds': args.duration,
+        'origin_latency_ms': args.origin_latency,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{'scenario':<16} {'req/s':>8} {'MB/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'ttfb p50':>9} {'errors':>7} {'rss MB':>8} {'disk MB':>8}")
+    for r in results:
+        print(f"{r['scenario']:<16} {r['throughput_rps']:>8} {r['throughput_mb_s']:>8} {r['latency_ms']['p50']!s:>9} "
+              f"{r['latency_ms']['p95']!s:>9} {r['latency_ms']['p99']!s:>9} {r['ttfb_ms']['p50']!s:>9} "
+              f"{r['errors']:>7} {r['peak_rss_mb']:>8} {r['peak_disk_mb']:>8}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+"""
+Compares the ways of cutting a segment out of a long video:
+
+  legacy  download the whole bestvideo+bestaudio stream, then trim it with ffmpeg
+          (what /download_timestamped_video used to do)
+  exact   yt-dlp download_ranges with keyframes forced at the cuts (re-encodes
+          only the requested section)
+  fast    yt-dlp download_ranges with stream copy (cuts snap to keyframes)
+
+For each mode it reports wall time, bytes transferred from the origin and the
+size of the resulting file. Needs network access (or a local origin) and ffmpeg.
+
+    python benchmarks/segment_benchmark.py URL --start 3600 --end 3630 [--json]
+    python benchmarks/segment_benchmark.py --local-origin [--duration 900] [--fake-media]
+
+--local-origin serves load_benchmark.py's synthetic MP4 from a local HTTP
+origin instead of fetching URL, so no network access is needed. Without
+ffmpeg, --fake-media serves random bytes instead; every mode still needs
+ffmpeg to cut, so it only shows how far each mode gets.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import yt_dlp  # noqa: E402
+from app import run_segment_download  # noqa: E402
+from load_benchmark import generate_media, start_origin  # noqa: E402
+
+
+def byte_counter():
+    """Returns a yt-dlp progress hook and a function reporting the bytes it saw."""
+    streams = {}
+
+    def hook(d):
+        if d.get('status') in ('downloading', 'finished'):
+            streams[d.get('filename')] = d.get('downloaded_bytes') or 0
+
+    return hook, lambda: sum(streams.values())
+
+
+def run_legacy(url, start, end, workdir):
+    hook, downloaded = byte_counter()
+    full_path = os.path.join(workdir, 'full.mp4')
+    ydl_opts = {
+        'format': 'bestvideo+bestaudio/best',
+        'outtmpl': full_path,
+        'merge_output_format': 'mp4',
+        'quiet': True,
+        'no_warnings': True,
+        'noplaylist': True,
+        'progress_hooks': [hook],
+    }
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        ydl.download([url])
+
+    output_path = os.path.join(workdir, 'legacy_segment.mp4')
+    subprocess.run(['ffmpeg', '-hide_banner', '-loglevel', 'error', '-y',
+                    '-i', full_path, '-ss', str(start), '-to', str(end), output_path], check=True)
+    return output_path, downloaded()
+
+
+def run_ranged(url, start, end, fast_cut):
+    downloaded = {}
+
+    def report(progress):
+        downloaded['bytes'] = progress.get('downloaded_bytes') or 0
+
+    output_path, _ = run_segment_download(url, start, end, 'benchmark', fast_cut=fast_cut, progress_callback=report)
+    return output_path, downloaded.get('bytes', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url', nargs='?')
+    parser.add_argument('--local-origin', action='store_true', help="cut load_benchmark.py's synthetic MP4 instead of URL")
+    parser.add_argument('--duration', type=int, default=900, help='seconds of synthetic media (--local-origin)')
+    parser.add_argument('--fake-media', action='store_true', help='serve random bytes instead of ffmpeg output (--local-origin)')
+    parser.add_argument('--start', type=float, default=600)
+    parser.add_argument('--end', type=float, default=630)
+    parser.add_argument('--modes', default='legacy,exact,fast')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    if not args.url and not args.local_origin:
+        parser.error("pass a URL or --local-origin")
+    if args.local_origin and not args.fake_media and not shutil.which('ffmpeg'):
+        parser.error("ffmpeg is needed to generate the media (or pass --fake-media)")
+
+    results = []
+    workdir = tempfile.mkdtemp(prefix='segment-bench-')
+    origin_server = None
+    try:
+        if args.local_origin:
+            media_dir = os.path.join(workdir, 'origin')
+            os.makedirs(media_dir)
+            generate_media(media_dir, args.duration, args.fake_media)
+            origin_server, origin = start_origin(media_dir)
+            args.url = f'{origin}/clip.mp4'
+
+        for mode in args.modes.split(','):
+            started = time.perf_counter()
+            try:
+                if mode == 'legacy':
+                    output_path, transferred = run_legacy(args.url, args.start, args.end, workdir)
+                else:
+                    output_path, transferred = run_ranged(args.url, args.start, args.end, fast_cut=(mode == 'fast'))
+            except Exception as e:
+                results.append({'mode': mode, 'seconds': round(time.perf_counter() - started, 2), 'error': str(e)})
+                continue
+            elapsed = time.perf_counter() - started
+            results.append({
+                'mode': mode,
+                'seconds': round(elapsed, 2),
+                'bytes_downloaded': transferred,
+                'output_bytes': os.path.getsize(output_path),
+            })
+            if not output_path.startswith(workdir):
+                os.remove(output_path)
+    finally:
+        if origin_server is not None:
+            origin_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({'url': args.url, 'start': args.start, 'end': args.end, 'results': results}, indent=2))
+        return
+
+    print(f"{'mode':<8} {'seconds':>10} {'downloaded':>14} {'output':>14}")
+    for result in results:
+        if 'error' in result:
+            print(f"{result['mode']:<8} {result['seconds']:>10}  failed: {result['error']}")
+            continue
+        print(f"{result['mode']:<8} {result['seconds']:>10} {result['bytes_downloaded']:>14} {result['output_bytes']:>14}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Measures what the YoutubeDL pool and the shared HTTP session save per request:
+
+  info       metadata extraction with a new YoutubeDL per call (fresh) versus a
+             pooled, pre-built instance (pooled)
+  thumbnail  thumbnail fetch with requests.get (fresh) versus the shared
+             keep-alive session (pooled)
+
+Each case runs --iterations times and reports p50/p99 latency in milliseconds.
+Set YOUTUBE_COOKIES_BASE64 as in production so cookie parsing is part of the
+fresh cost.
+
+    python benchmarks/ydl_pool_benchmark.py URL [--thumbnail-url URL] [--iterations 50] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import requests  # noqa: E402
+import yt_dlp  # noqa: E402
+from app import YDL_PROFILES, build_ydl_opts, http_session, ydl_pool  # noqa: E402
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def measure(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return {'p50_ms': round(percentile(samples, 50), 2), 'p99_ms': round(percentile(samples, 99), 2)}
+
+
+def fresh_info(url):
+    base_opts, use_proxy = YDL_PROFILES['info']
+    with yt_dlp.YoutubeDL(build_ydl_opts(dict(base_opts), 'benchmark', use_proxy=use_proxy)) as ydl:
+        ydl.extract_info(url, download=False)
+
+
+def pooled_info(url):
+    with ydl_pool.borrow('info') as ydl:
+        ydl.extract_info(url, download=False)
+
+
+def fetch_thumbnail(get, url):
+    response = get(url, stream=True, timeout=(10, 30))
+    response.raise_for_status()
+    for _ in response.iter_content(chunk_size=8192):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('url')
+    parser.add_argument('--thumbnail-url')
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+
+    cases = [
+        ('info', 'fresh', lambda: fresh_info(args.url)),
+        ('info', 'pooled', lambda: pooled_info(args.url)),
+    ]
+    if args.thumbnail_url:
+        cases += [
+            ('thumbnail', 'fresh', lambda: fetch_thumbnail(requests.get, args.thumbnail_url)),
+            ('thumbnail', 'pooled', lambda: fetch_thumbnail(http_session.get, args.thumbnail_url)),
+        ]
+
+    results = []
+    for case, variant, fn in cases:
+        fn()  # warm-up, so DNS and extractor imports aren't counted
+        results.append({'case': case, 'variant': variant, **measure(fn, args.iterations)})
+
+    if args.json:
+        print(json.dumps({'url': args.url, 'iterations': args.iterations, 'results': results}, indent=2))
+        return
+
+    print(f"{'case':<10} {'variant':<8} {'p50 ms':>10} {'p99 ms':>10}")
+    for result in results:
+        print(f"{result['case']:<10} {result['variant']:<8} {result['p50_ms']:>10} {result['p99_ms']:>10}")
+
+
+if __name__ == '__main__':
+    main()
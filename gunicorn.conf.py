@@ -0,0 +1,43 @@
+"""
+Production server profile, picked up by `gunicorn app:app` from the working
+directory (render.yaml passes it explicitly).
+
+Downloads are long and almost entirely I/O: waiting on YouTube, on ffmpeg and
+on slow clients. The default gevent worker runs each request in a greenlet, so
+a worker holds hundreds of them for the cost of a few sync workers (gthread,
+with GUNICORN_THREADS threads per worker, is the fallback when gevent isn't
+available). preload_app imports the app once in the master: yt-dlp's
+extractors, the decoded cookies and the warmed YoutubeDL pool are built a
+single time and shared copy-on-write by the forked workers.
+
+Greenlets only yield on I/O. yt-dlp's extraction (parsing the player page,
+JSON and signature code) is pure Python and blocks its worker's whole event
+loop while it runs, so every other request on that worker, progress streams
+included, stalls for the duration. That is why WEB_CONCURRENCY defaults to 2
+and should never go below it: one worker busy extracting must not freeze the
+service. On hosts with more CPUs, raise it to roughly one worker per CPU.
+
+    GUNICORN_WORKER_CLASS  gevent (default) or gthread
+    WEB_CONCURRENCY        worker processes (default 2)
+    PORT                   listen port, bound on 0.0.0.0 (gunicorn's default)
+"""
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+if worker_class == 'gevent':
+    # The app is imported in the master (preload_app), so the stdlib has to be
+    # patched before that import, not only by each worker after the fork
+    from gevent import monkey
+    monkey.patch_all()
+
+workers = max(2, int(os.getenv('WEB_CONCURRENCY', '2')))  # see above: extraction blocks a gevent worker
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '1000'))  # gevent: requests per worker
+threads = int(os.getenv('GUNICORN_THREADS', '32'))  # gthread: requests per worker
+preload_app = True
+timeout = 120  # seconds without a heartbeat before a worker is restarted
+graceful_timeout = 60  # lets most in-flight downloads finish on restart
+keepalive = 5
+
+# With several workers on one instance, coalesce identical cold downloads across
+# all of them (flock under downloads/.locks) instead of per worker
+os.environ.setdefault('SINGLE_FLIGHT_MODE', 'file')
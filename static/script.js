@@ -20,6 +20,7 @@ const downloadBtn = document.getElementById('downloadBtn');
 const startTimeInput = document.getElementById('startTime');
 const endTimeInput = document.getElementById('endTime');
 const downloadSegmentBtn = document.getElementById('downloadSegmentBtn');
+const fastCutCheckbox = document.getElementById('fastCutCheckbox');
 const formatToggleBtns = document.querySelectorAll('.format-toggle-btn');
 
 const themeToggleBtn = document.getElementById('themeToggle');
@@ -34,6 +35,12 @@ let currentAudioFormats = [];
 let currentVideoTitle = '';
 let currentHdThumbnailUrl = '';
 let videoDurationSeconds = 0;
+let shownVideoUrl = '';
+let infoController = null; // Aborts the lookup in flight when another URL is looked up
+let infoLookupUrl = '';
+let prefetchTimer = null;
+
+const YOUTUBE_URL_REGEX = /^(?:https?:\/\/)?(?:www\.)?(?:m\.)?(?:youtube\.com|youtu\.be)\/(?:watch\?v=|embed\/|v\/|)([\w-]{11})(?:\S+)?$/;
 
 // --- Helper Functions ---
 
@@ -166,21 +173,114 @@ function applyTimeFormat(format) {
     document.querySelector(`.format-toggle-btn[data-format="${format}"]`).classList.add('active');
 }
 
+// --- Video Info Cache ---
+// Lookups are kept in localStorage so revisits and repeat lookups render without
+// waiting for the server. Entries younger than their TTL are used as they are;
+// older ones are revalidated with If-None-Match, and the server answers 304 when
+// nothing changed.
+
+const INFO_CACHE_PREFIX = 'fastvid:';
+const SUMMARY_CACHE_TTL_MS = 6 * 60 * 60 * 1000; // Titles and channels rarely change
+const FORMATS_CACHE_TTL_MS = 30 * 60 * 1000;
+const INFO_CACHE_MAX_AGE_MS = 7 * 24 * 60 * 60 * 1000; // Older entries are dropped rather than revalidated
+const PREFETCH_DEBOUNCE_MS = 400;
+
+class InfoRequestError extends Error {}
+
+function readCachedResponse(key) {
+    try {
+        const entry = JSON.parse(localStorage.getItem(INFO_CACHE_PREFIX + key));
+        return entry && entry.data ? entry : null;
+    } catch (error) {
+        return null; // Storage disabled, or a corrupt entry
+    }
+}
+
+function writeCachedResponse(key, entry) {
+    try {
+        localStorage.setItem(INFO_CACHE_PREFIX + key, JSON.stringify(entry));
+    } catch (error) {
+        pruneInfoCache(0); // Over quota: start the cache over instead of failing the lookup
+    }
+}
+
+function pruneInfoCache(maxAgeMs) {
+    try {
+        for (let i = localStorage.length - 1; i >= 0; i--) {
+            const key = localStorage.key(i);
+            if (!key || !key.startsWith(INFO_CACHE_PREFIX)) {
+                continue;
+            }
+            const entry = readCachedResponse(key.slice(INFO_CACHE_PREFIX.length));
+            if (!entry || Date.now() - entry.storedAt >= maxAgeMs) {
+                localStorage.removeItem(key);
+            }
+        }
+    } catch (error) {
+        // Storage disabled; nothing to prune
+    }
+}
+
+// `toCached` picks what gets stored under `key`; the full response is still returned
+async function fetchCachedJson(key, url, options, ttlMs, toCached = data => data) {
+    const cached = readCachedResponse(key);
+    if (cached && Date.now() - cached.storedAt < ttlMs) {
+        return cached.data;
+    }
+
+    const headers = { ...options.headers };
+    if (cached && cached.etag) {
+        headers['If-None-Match'] = cached.etag;
+    }
+    const response = await fetch(url, { ...options, headers });
+    if (response.status === 304 && cached) {
+        writeCachedResponse(key, { ...cached, storedAt: Date.now() });
+        return cached.data;
+    }
+
+    const data = await response.json();
+    if (!response.ok) {
+        throw new InfoRequestError(data.error || 'Failed to get video info.');
+    }
+    writeCachedResponse(key, { data: toCached(data), etag: response.headers.get('ETag'), storedAt: Date.now() });
+    return data;
+}
+
+function cacheInlineFormatIndex(info) {
+    if (!info.video_formats) {
+        return info;
+    }
+    // Formats sent along with the summary expire like phase two's, not with the summary
+    writeCachedResponse(`formats:${info.formats_url}`, { data: info, etag: null, storedAt: Date.now() });
+    const { video_formats, audio_formats, ...summary } = info;
+    return summary;
+}
+
 // --- Main Functions ---
 
 async function getVideoInformation() {
+    clearTimeout(prefetchTimer);
     const videoUrl = videoUrlInput.value.trim();
     if (!videoUrl) {
         showStatus('Please enter a YouTube video URL.', 'error');
         return;
     }
 
-    const youtubeRegex = /^(?:https?:\/\/)?(?:www\.)?(?:m\.)?(?:youtube\.com|youtu\.be)\/(?:watch\?v=|embed\/|v\/|)([\w-]{11})(?:\S+)?$/;
-    if (!youtubeRegex.test(videoUrl)) {
+    if (!YOUTUBE_URL_REGEX.test(videoUrl)) {
         showStatus('Please enter a valid YouTube URL (e.g., youtube.com/watch?v=...).', 'error');
         return;
     }
 
+    if (infoController && infoLookupUrl === videoUrl) {
+        return; // Already being looked up, e.g. prefetched on paste
+    }
+    if (infoController) {
+        infoController.abort();
+    }
+    const controller = new AbortController();
+    infoController = controller;
+    infoLookupUrl = videoUrl;
+
     showLoading('Fetching video information...');
     videoInfoSection.style.display = 'none';
     videoQualitySelect.innerHTML = '<option value="">-- Select Video --</option>';
@@ -191,54 +291,94 @@ async function getVideoInformation() {
     startTimeInput.value = '';
     endTimeInput.value = '';
 
+    let summaryShown = false;
     try {
-        const response = await fetch(`${API_BASE_URL}/get_video_info`, {
+        // Phase one: title, channel and thumbnail, quick enough to show right away
+        const data = await fetchCachedJson(`info:${videoUrl}`, `${API_BASE_URL}/get_video_info`, {
             method: 'POST',
             headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({ url: videoUrl })
-        });
-
-        const data = await response.json();
+            body: JSON.stringify({ url: videoUrl }),
+            signal: controller.signal
+        }, SUMMARY_CACHE_TTL_MS, cacheInlineFormatIndex);
 
-        if (response.ok) {
-            hideLoading();
-            showStatus('Video information retrieved successfully!', 'success');
-            displayVideoInfo(data);
-            currentVideoTitle = data.title;
-            currentVideoFormats = data.video_formats || [];
-            currentAudioFormats = data.audio_formats || [];
-            currentHdThumbnailUrl = data.hd_thumbnail || data.thumbnail;
-            videoDurationSeconds = data.duration;
-
-            // Set default timestamp values
-            if (videoDurationSeconds && videoDurationSeconds > 0) {
-                startTimeInput.value = secondsToHHMMSS(0);
-                endTimeInput.value = secondsToHHMMSS(Math.min(videoDurationSeconds, 600)); // Default 10 mins or end of video
-            } else {
-                startTimeInput.value = '00:00:00';
-                endTimeInput.value = '00:00:10';
-            }
-            applyTimeFormat('hhmmss'); // Activate HH:MM:SS format button
+        hideLoading();
+        displayVideoInfo(data);
+        summaryShown = true;
+        shownVideoUrl = videoUrl;
+        currentVideoTitle = data.title;
+        currentHdThumbnailUrl = data.hd_thumbnail || data.thumbnail;
+        downloadHdThumbnailBtn.disabled = false;
 
-            populateQualityDropdowns();
-            downloadHdThumbnailBtn.disabled = false;
-            downloadSegmentBtn.disabled = false;
-            startTimeInput.disabled = false;
-            endTimeInput.disabled = false;
+        if (data.video_formats) {
+            applyFormatIndex(data); // Already indexed on the server
         } else {
-            hideLoading();
-            showStatus(`Error: ${data.error || 'Failed to get video info.'}`, 'error');
-            videoInfoSection.style.display = 'none';
+            // Phase two: the format lists (plus duration and views, which the
+            // quick summary may not have yet)
+            showStatus('Loading available qualities...', 'info');
+            applyFormatIndex(await fetchCachedJson(`formats:${data.formats_url}`, `${API_BASE_URL}${data.formats_url}`, {
+                signal: controller.signal
+            }, FORMATS_CACHE_TTL_MS));
         }
 
     } catch (error) {
+        if (error.name === 'AbortError') {
+            return; // Superseded by a lookup of another URL
+        }
         console.error('Error fetching video info:', error);
         hideLoading();
-        showStatus('Network error or server unavailable. Please try again later.', 'error');
-        videoInfoSection.style.display = 'none';
+        if (error instanceof InfoRequestError) {
+            showStatus(`Error: ${error.message}`, 'error');
+        } else {
+            showStatus('Network error or server unavailable. Please try again later.', 'error');
+        }
+        if (!summaryShown) {
+            videoInfoSection.style.display = 'none';
+        }
+    } finally {
+        if (infoController === controller) {
+            infoController = null;
+            infoLookupUrl = '';
+        }
     }
 }
 
+// Looks the video up as soon as a YouTube URL has been pasted (or typed) and
+// the input has settled, so the qualities are usually listed before the user
+// reaches for the button
+function schedulePrefetch() {
+    clearTimeout(prefetchTimer);
+    prefetchTimer = setTimeout(() => {
+        const videoUrl = videoUrlInput.value.trim();
+        if (YOUTUBE_URL_REGEX.test(videoUrl) && videoUrl !== shownVideoUrl) {
+            getVideoInformation();
+        }
+    }, PREFETCH_DEBOUNCE_MS);
+}
+
+function applyFormatIndex(info) {
+    showStatus('Video information retrieved successfully!', 'success');
+    displayVideoInfo(info);
+    currentVideoFormats = info.video_formats || [];
+    currentAudioFormats = info.audio_formats || [];
+    currentHdThumbnailUrl = info.hd_thumbnail || info.thumbnail;
+    videoDurationSeconds = info.duration;
+
+    // Set default timestamp values
+    if (videoDurationSeconds && videoDurationSeconds > 0) {
+        startTimeInput.value = secondsToHHMMSS(0);
+        endTimeInput.value = secondsToHHMMSS(Math.min(videoDurationSeconds, 600)); // Default 10 mins or end of video
+    } else {
+        startTimeInput.value = '00:00:00';
+        endTimeInput.value = '00:00:10';
+    }
+    applyTimeFormat('hhmmss'); // Activate HH:MM:SS format button
+
+    populateQualityDropdowns();
+    downloadSegmentBtn.disabled = false;
+    startTimeInput.disabled = false;
+    endTimeInput.disabled = false;
+}
+
 function displayVideoInfo(info) {
     thumbnailImg.src = info.thumbnail;
     thumbnailImg.alt = info.title;
@@ -281,6 +421,110 @@ function updateDownloadButtonState() {
     downloadBtn.disabled = !(selectedVideo || selectedAudio);
 }
 
+// --- Download Jobs ---
+// Downloads run as background jobs on the server. We submit a job, follow its
+// real progress over Server-Sent Events, then let the browser fetch the file.
+
+const STAGE_LABELS = {
+    download: 'Downloading',
+    merge: 'Merging audio and video',
+    convert: 'Converting',
+    remux: 'Remuxing',
+    postprocess: 'Processing',
+    disk_wait: 'Waiting for disk space'
+};
+
+function updateJobProgress(job) {
+    if (job.state === 'queued') {
+        showStatus('Waiting for a free download slot...', 'info');
+        return;
+    }
+    const progress = job.progress;
+    if (!progress) {
+        showStatus('Starting download...', 'info');
+        return;
+    }
+
+    const label = STAGE_LABELS[progress.stage] || 'Processing';
+    if (progress.stage !== 'download') {
+        progressBar.style.width = progress.stage === 'disk_wait' ? '0%' : '100%';
+        showStatus(`${label}...`, 'info');
+        return;
+    }
+
+    const details = [];
+    if (progress.total_bytes) {
+        const percent = Math.min(100, (progress.downloaded_bytes / progress.total_bytes) * 100);
+        progressBar.style.width = `${percent.toFixed(1)}%`;
+        details.push(`${percent.toFixed(0)}% of ${formatFileSize(progress.total_bytes)}`);
+    } else if (progress.downloaded_bytes) {
+        details.push(formatFileSize(progress.downloaded_bytes));
+    }
+    if (progress.speed) details.push(`${formatFileSize(progress.speed)}/s`);
+    if (typeof progress.eta === 'number') details.push(`${formatDuration(progress.eta)} left`);
+
+    showStatus(`${label}... ${details.join(' · ')}`, 'info');
+}
+
+async function startDownloadJob(payload) {
+    const response = await fetch(`${API_BASE_URL}/jobs`, {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify(payload)
+    });
+    const data = await response.json();
+
+    if (response.status === 429) {
+        const retryAfter = response.headers.get('Retry-After');
+        throw new Error(`${data.error}${retryAfter ? ` (try again in ${retryAfter} seconds)` : ''}`);
+    }
+    if (!response.ok) {
+        throw new Error(data.error || 'Failed to start download.');
+    }
+    return data;
+}
+
+function followDownloadJob(job) {
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(`${API_BASE_URL}${job.events_url}`);
+
+        source.addEventListener('progress', (event) => updateJobProgress(JSON.parse(event.data)));
+        source.addEventListener('finished', (event) => {
+            source.close();
+            resolve(JSON.parse(event.data));
+        });
+        source.addEventListener('failed', (event) => {
+            source.close();
+            reject(new Error(JSON.parse(event.data).error || 'Download failed.'));
+        });
+        source.onerror = () => {
+            // The browser reconnects on its own unless the stream was refused outright
+            if (source.readyState === EventSource.CLOSED) {
+                reject(new Error('Lost connection to the server while downloading.'));
+            }
+        };
+    });
+}
+
+function saveJobFile(job) {
+    // The server sends the file as an attachment, so the browser streams it
+    // straight into its downloads instead of buffering a blob in memory.
+    const a = document.createElement('a');
+    a.style.display = 'none';
+    a.href = `${API_BASE_URL}${job.file_url}`;
+    a.download = job.download_name || '';
+    document.body.appendChild(a);
+    a.click();
+    a.remove();
+}
+
+function describeDownloadError(error) {
+    if (error instanceof TypeError) {
+        return 'Network error or server unavailable during download. Please try again.';
+    }
+    return `Error: ${error.message}`;
+}
+
 async function downloadSelectedMedia() {
     const selectedVideoFormatId = videoQualitySelect.value;
     const selectedVideoExt = videoQualitySelect.selectedOptions[0]?.dataset.ext;
@@ -320,71 +564,28 @@ async function downloadSelectedMedia() {
     downloadBtn.disabled = true;
 
     try {
-        // Simulated progress bar for visual feedback
-        let simulatedProgress = 0;
-        const progressInterval = setInterval(() => {
-            if (simulatedProgress < 90) { // Stop at 90% to indicate server processing
-                simulatedProgress += 5;
-                progressBar.style.width = `${simulatedProgress}%`;
-            }
-        }, 500); // Update every 0.5 seconds
-
-        const response = await fetch(`${API_BASE_URL}/download_video`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                url: videoUrl,
-                format_id: formatIdToDownload,
-                ext: extToDownload,
-                title: currentVideoTitle
-            })
+        const job = await startDownloadJob({
+            type: 'video',
+            url: videoUrl,
+            format_id: formatIdToDownload,
+            ext: extToDownload,
+            title: currentVideoTitle
         });
+        updateJobProgress(job);
 
-        clearInterval(progressInterval); // Stop simulation
-        progressBar.style.width = '100%'; // Complete progress
-
-        if (response.ok) {
-            const contentDisposition = response.headers.get('Content-Disposition');
-            let filename = 'download';
-            if (contentDisposition && contentDisposition.indexOf('attachment') !== -1) {
-                const filenameMatch = contentDisposition.match(/filename\*?=['"]?(?:UTF-\d['"]*)?([^;\r\n"']*)['"]?;?/);
-                if (filenameMatch && filenameMatch[1]) {
-                    try {
-                        filename = decodeURIComponent(filenameMatch[1].replace(/\+/g, ' '));
-                    } catch (e) {
-                        filename = filenameMatch[1];
-                    }
-                }
-            } else {
-                filename = `${currentVideoTitle || 'video'}.${extToDownload || 'mp4'}`;
-            }
-
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.style.display = 'none';
-            a.href = url;
-            a.download = filename;
-            document.body.appendChild(a);
-            a.click();
-            window.URL.revokeObjectURL(url);
-            a.remove();
+        const finishedJob = await followDownloadJob(job);
+        progressBar.style.width = '100%';
+        saveJobFile(finishedJob);
 
-            showStatus('Download started! Check your browser\'s downloads. (Download Complete!)', 'success');
-            videoQualitySelect.value = '';
-            audioQualitySelect.value = '';
-            updateDownloadButtonState();
-            progressContainer.style.display = 'none';
-        } else {
-            const errorData = await response.json();
-            showStatus(`Error: ${errorData.error || 'Failed to start download.'}`, 'error');
-            downloadBtn.disabled = false;
-            progressContainer.style.display = 'none';
-        }
+        showStatus('Download started! Check your browser\'s downloads. (Download Complete!)', 'success');
+        videoQualitySelect.value = '';
+        audioQualitySelect.value = '';
+        updateDownloadButtonState();
+        progressContainer.style.display = 'none';
 
     } catch (error) {
-        console.error('Error initiating download:', error);
-        showStatus('Network error or server unavailable during download. Please try again.', 'error');
+        console.error('Error during download:', error);
+        showStatus(describeDownloadError(error), 'error');
         downloadBtn.disabled = false;
         progressContainer.style.display = 'none';
     } finally {
@@ -402,14 +603,12 @@ async function downloadHdThumbnail() {
     downloadHdThumbnailBtn.disabled = true;
 
     try {
-        const response = await fetch(`${API_BASE_URL}/download_thumbnail`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                thumbnail_url: currentHdThumbnailUrl,
-                video_title: currentVideoTitle
-            })
+        // GET so the browser cache can revalidate it (the server answers 304 when unchanged)
+        const params = new URLSearchParams({
+            thumbnail_url: currentHdThumbnailUrl,
+            video_title: currentVideoTitle
         });
+        const response = await fetch(`${API_BASE_URL}/download_thumbnail?${params}`);
 
         if (response.ok) {
             const contentDisposition = response.headers.get('Content-Disposition');
@@ -491,68 +690,29 @@ async function downloadVideoSegment() {
     downloadSegmentBtn.disabled = true;
 
     try {
-        let simulatedProgress = 0;
-        const progressInterval = setInterval(() => {
-            if (simulatedProgress < 90) {
-                simulatedProgress += 5;
-                progressBar.style.width = `${simulatedProgress}%`;
-            }
-        }, 500);
-
-        const response = await fetch(`${API_BASE_URL}/download_timestamped_video`, {
-            method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
-            body: JSON.stringify({
-                url: videoUrl,
-                start_time: startTime,
-                end_time: endTime,
-                title: currentVideoTitle
-            })
+        const job = await startDownloadJob({
+            type: 'segment',
+            url: videoUrl,
+            start_time: startTime,
+            end_time: endTime,
+            fast_cut: fastCutCheckbox.checked,
+            title: currentVideoTitle
         });
+        updateJobProgress(job);
 
-        clearInterval(progressInterval);
+        const finishedJob = await followDownloadJob(job);
         progressBar.style.width = '100%';
+        saveJobFile(finishedJob);
 
-        if (response.ok) {
-            const contentDisposition = response.headers.get('Content-Disposition');
-            let filename = 'download_segment.mp4';
-            if (contentDisposition && contentDisposition.indexOf('attachment') !== -1) {
-                const filenameMatch = contentDisposition.match(/filename\*?=['"]?(?:UTF-\d['"]*)?([^;\r\n"']*)['"]?;?/);
-                if (filenameMatch && filenameMatch[1]) {
-                    try {
-                        filename = decodeURIComponent(filenameMatch[1].replace(/\+/g, ' '));
-                    } catch (e) {
-                        filename = filenameMatch[1];
-                    }
-                }
-            }
-
-            const blob = await response.blob();
-            const url = window.URL.createObjectURL(blob);
-            const a = document.createElement('a');
-            a.style.display = 'none';
-            a.href = url;
-            a.download = filename;
-            document.body.appendChild(a);
-            a.click();
-            window.URL.revokeObjectURL(url);
-            a.remove();
-
-            showStatus('Video segment download started! Check your browser\'s downloads. (Download Complete!)', 'success');
-            startTimeInput.value = '';
-            endTimeInput.value = '';
-            downloadSegmentBtn.disabled = false;
-            progressContainer.style.display = 'none';
-        } else {
-            const errorData = await response.json();
-            showStatus(`Error: ${errorData.error || 'Failed to download segment.'}`, 'error');
-            downloadSegmentBtn.disabled = false;
-            progressContainer.style.display = 'none';
-        }
+        showStatus('Video segment download started! Check your browser\'s downloads. (Download Complete!)', 'success');
+        startTimeInput.value = '';
+        endTimeInput.value = '';
+        downloadSegmentBtn.disabled = false;
+        progressContainer.style.display = 'none';
 
     } catch (error) {
-        console.error('Error initiating segment download:', error);
-        showStatus('Network error or server unavailable during segment download. Please try again.', 'error');
+        console.error('Error during segment download:', error);
+        showStatus(describeDownloadError(error), 'error');
         downloadSegmentBtn.disabled = false;
         progressContainer.style.display = 'none';
     } finally {
@@ -564,6 +724,7 @@ async function downloadVideoSegment() {
 // --- Event Listeners ---
 
 getInfoBtn.addEventListener('click', getVideoInformation);
+videoUrlInput.addEventListener('input', schedulePrefetch);
 downloadHdThumbnailBtn.addEventListener('click', downloadHdThumbnail);
 downloadBtn.addEventListener('click', downloadSelectedMedia);
 downloadSegmentBtn.addEventListener('click', downloadVideoSegment);
@@ -584,4 +745,5 @@ videoUrlInput.addEventListener('keypress', (event) => {
         event.preventDefault();
         getInfoBtn.click();
     }
-});
\ No newline at end of file
+});
+pruneInfoCache(INFO_CACHE_MAX_AGE_MS);